@@ -1,20 +1,98 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+import bisect
+import gc
+import functools
+import hashlib
+import inspect
+import io
+import itertools
+import json
+import marshal
+import multiprocessing
 import re
 import operator
 import os
 import string
 import sys
+import tempfile
+import threading
+import time
+import types
+import warnings
+from collections import deque
 
 import six
+from cachetools import Cache, LRUCache
+from six.moves import cPickle as pickle, collections_abc, intern, queue, zip
+try:
+    from importlib.util import MAGIC_NUMBER as CODE_MAGIC_NUMBER
+except ImportError:
+    # Python 2
+    from imp import get_magic
+    CODE_MAGIC_NUMBER = get_magic()
+
+__version__ = '0.5.16'
 
 __all__ = [
     'Template',
     'TemplateError',
     'TemplateExecutionError',
     'TemplateSyntaxError',
-    'CachingFileLoader']
+    'CachingFileLoader',
+    'Profiler',
+    'register_method']
+
+
+class _MethodTable(dict):
+    """A dict of additional methods which counts the changes made to it.
+
+    Dicts stored in it become _MethodTables too, so that changes to the
+    methods of a class are counted as well.
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, value):
+        if type(value) is dict:
+            value = _MethodTable(value)
+        dict.__setitem__(self, key, value)
+        _additional_method_changes[0] += 1
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        _additional_method_changes[0] += 1
+
+    def clear(self):
+        dict.clear(self)
+        _additional_method_changes[0] += 1
+
+    def pop(self, *args):
+        value = dict.pop(self, *args)
+        _additional_method_changes[0] += 1
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        _additional_method_changes[0] += 1
+        return item
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+# How often __additional_methods__ has changed
+_additional_method_changes = [0]
+
 
 # A dict that maps classes to dicts of additional methods.
 # This allows support for methods that are available in Java-based Velocity
@@ -24,7 +102,11 @@ __all__ = [
 #
 # For example, given a template variable "$foo = [1,2,3]", "$foo.size()" will
 # result in calling method __additional_methods__[list]['size']($foo)
-__additional_methods__ = {
+#
+# Methods for a class also apply to its subclasses.  Lookups are cached, and
+# the cache is dropped whenever methods are added, replaced or removed, with
+# register_method() or by changing these dicts directly.
+__additional_methods__ = _MethodTable({
     str: {
         'length': lambda self: len(self),
         'replaceAll': lambda self, pattern, repl: re.sub(pattern, repl, self)
@@ -38,7 +120,46 @@ __additional_methods__ = {
     dict: {
         'put': lambda self, key, value: self.update({key: value})
     }
-}
+})
+
+# (class, name) -> function or None
+_additional_method_cache = {}
+# The changes and table _additional_method_cache was filled from
+_additional_method_cache_source = [None, None]
+
+
+def register_method(cls, name, function):
+    """Makes $x.name(...) call function(x, ...) for instances x of cls.
+
+    Subclasses of cls are included.  As with the predefined methods, items
+    and attributes of x called name take precedence.
+    """
+    __additional_methods__.setdefault(cls, {})[name] = function
+
+
+def find_additional_method(cls, name):
+    source = _additional_method_cache_source
+    if source[0] != _additional_method_changes[0] or \
+            source[1] is not __additional_methods__:
+        # methods were changed, or __additional_methods__ replaced
+        _additional_method_cache.clear()
+        source[:] = [_additional_method_changes[0], __additional_methods__]
+    try:
+        return _additional_method_cache[cls, name]
+    except KeyError:
+        pass
+    method = None
+    if not issubclass(cls, LocalNamespace):
+        for base in inspect.getmro(cls):
+            methods = __additional_methods__.get(base)
+            if methods and name in methods:
+                method = methods[name]
+                break
+    if len(_additional_method_cache) > 10000:
+        _additional_method_cache.clear()
+    _additional_method_cache[cls, name] = method
+    return method
+
 
 try:
     dict
@@ -79,30 +200,241 @@ def boolean_value(variable_value):
     return not (variable_value is None)
 
 
+def boolean_or(a, b):
+    return boolean_value(a) or boolean_value(b)
+
+
+def boolean_and(a, b):
+    return boolean_value(a) and boolean_value(b)
+
+
 def is_valid_vtl_identifier(text):
     return text and text[0] in set(string.ascii_letters + '_')
 
 
 class Template:
-    def __init__(self, content, filename="<string>"):
+    # When true, the blocks of the parsed template are turned into Python
+    # functions (see CodeGenerator) the first time the template is compiled.
+    codegen = False
+    # A Profiler recording where the time goes in merges; see Profiler.
+    profiler = None
+
+    def __init__(self, content, filename="<string>", codegen=None):
         self.content = content
         self.filename = filename
         self.root_element = None
+        if codegen is not None:
+            self.codegen = codegen
+
+    @classmethod
+    def from_string_cached(cls, content, filename="<string>", codegen=None):
+        """Returns a compiled template for content, parsing it only once.
+
+        Templates are shared through Template.string_cache, a process-wide
+        TemplateCache keyed on the content, so the result must not be
+        modified.  Used by #evaluate.
+        """
+        if codegen is None:
+            codegen = cls.codegen
+        key = (content, filename, codegen)
+        with cls.string_cache_lock:
+            cached = cls.string_cache.get(key)
+        if cached is not None:
+            return cached[0]
+        template = cls(content, filename, codegen)
+        template.ensure_compiled()
+        with cls.string_cache_lock:
+            cls.string_cache[key] = [template]
+        return template
 
     def merge(self, namespace, loader=None):
-        output = StoppableStream()
+        output = OutputBuffer()
         self.merge_to(namespace, output, loader)
         return output.getvalue()
 
     def ensure_compiled(self):
         if not self.root_element:
-            self.root_element = TemplateBody(self.filename, self.content)
-
-    def merge_to(self, namespace, fileobj, loader=None):
+            root_element = TemplateBody(_Source(self.filename, self.content))
+            root_element.prepare([], _MacroSites())
+            if self.codegen:
+                CodeGenerator.compile_blocks(root_element)
+            self.root_element = root_element
+
+    def approximate_size(self):
+        """Estimates the memory held by the parsed template, in bytes."""
+        self.ensure_compiled()
+        size = sys.getsizeof(self.content)
+        elements = [self.root_element]
+        while elements:
+            element = elements.pop()
+            size += sys.getsizeof(element)
+            if hasattr(element, '__dict__'):
+                size += sys.getsizeof(element.__dict__)
+            elements.extend(element.child_elements())
+        return size
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # The blocks rebuild their generated functions if this version of
+        # Python pickled them; otherwise they are generated again
+        if self.codegen and self.root_element and \
+                self.root_element.block.compiled is None:
+            CodeGenerator.compile_blocks(self.root_element)
+
+    def merge_iter(self, namespace, loader=None, chunk_size=8192):
+        """Yields the merged output in chunks as it is produced.
+
+        Chunks are at least chunk_size characters long, apart from the last
+        one, so the output never needs to be held in memory as a whole.
+        Iteration ends early at a #stop directive.
+        """
+        if loader is None:
+            loader = NullLoader()
+        self.ensure_compiled()
+        stream = StoppableStream()
+        chunks = self.root_element.evaluate_iter(stream, namespace, loader)
+        try:
+            for _ in chunks:
+                if stream.tell() >= chunk_size:
+                    yield stream.getvalue()
+                    stream.seek(0)
+                    stream.truncate()
+        except Stop:
+            pass
+        except (TemplateExecutionError, ControlFlow, GeneratorExit):
+            raise
+        except:
+            raise_execution_error(sys.exc_info())
+        chunk = stream.getvalue()
+        if chunk:
+            yield chunk
+
+    def merge_to(self, namespace, fileobj, loader=None, flush_size=None,
+                 encoding=None):
+        """Writes the merged output to fileobj, a file or a socket.
+
+        Output is passed on in chunks of at least flush_size characters,
+        by default OutputBuffer.FLUSH_SIZE, encoded first if an encoding is
+        given.
+        """
         if loader is None:
             loader = NullLoader()
         self.ensure_compiled()
-        self.root_element.evaluate(fileobj, namespace, loader)
+        if isinstance(fileobj, OutputBuffer) and encoding is None:
+            # a sub-template, or a merge()
+            output = fileobj
+        else:
+            if flush_size is None:
+                flush_size = OutputBuffer.FLUSH_SIZE
+            output = OutputBuffer(fileobj, flush_size, encoding)
+        try:
+            if self.profiler is None:
+                self.root_element.evaluate(output, namespace, loader)
+            else:
+                self.profiler.evaluate(self.root_element, output, namespace,
+                                       loader)
+        except Stop:
+            # A #stop ends every enclosing template, not just a sub-template
+            if isinstance(namespace, LocalNamespace):
+                raise
+        except (TemplateExecutionError, ControlFlow):
+            raise
+        except:
+            raise_execution_error(sys.exc_info())
+        finally:
+            if output is not fileobj:
+                output.flush()
+
+    def merge_many(self, namespaces, workers=None, loader=None, ordered=True,
+                   chunk_size=100, max_pending=None):
+        """Merges the template with each of namespaces in worker processes.
+
+        Yields the outputs in the order of namespaces or, if ordered is
+        false, (index in namespaces, output) pairs as soon as each is ready.
+        The template and loader are pickled and sent to each of the workers
+        (by default one per CPU) once; the namespaces go in chunks of
+        chunk_size, read from namespaces only as needed to keep max_pending
+        chunks (by default two per worker) in hand, so namespaces can be a
+        generator over more than would fit in memory at once.  An error in
+        a worker is raised here, and stops the rest of the work.
+        """
+        self.ensure_compiled()
+        # pickled here, not in each worker, so that problems show up here
+        job = pickle.dumps((self, loader), pickle.HIGHEST_PROTOCOL)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if max_pending is None:
+            max_pending = 2 * workers
+        namespaces = iter(namespaces)
+        chunks = iter(lambda: list(itertools.islice(namespaces, chunk_size)),
+                      [])
+        pool = multiprocessing.Pool(workers, _start_merge_worker, (job,))
+        try:
+            if ordered:
+                pending = deque()
+                for start, chunk in zip(itertools.count(0, chunk_size),
+                                        chunks):
+                    pending.append(pool.apply_async(_merge_chunk,
+                                                    (start, chunk)))
+                    if len(pending) >= max_pending:
+                        for output in _merged(pending.popleft().get()):
+                            yield output
+                while pending:
+                    for output in _merged(pending.popleft().get()):
+                        yield output
+            else:
+                done = queue.Queue()
+                pending = {}
+                for start, chunk in zip(itertools.count(0, chunk_size),
+                                        itertools.chain(chunks, [None])):
+                    if chunk is not None:
+                        pending[start] = pool.apply_async(
+                            _merge_chunk, (start, chunk), callback=done.put)
+                    while len(pending) >= max_pending or \
+                            (chunk is None and pending):
+                        try:
+                            result = done.get(timeout=0.1)
+                        except queue.Empty:
+                            # a result that couldn't be sent back never
+                            # reaches the callback, but get() raises why
+                            for async_result in list(pending.values()):
+                                if async_result.ready():
+                                    async_result.get()
+                            continue
+                        del pending[result[0]]
+                        for i, output in enumerate(_merged(result),
+                                                   result[0]):
+                            yield i, output
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+# The template and loader that a merge_many worker process merges with
+_merge_job = None
+
+
+def _start_merge_worker(job):
+    global _merge_job
+    _merge_job = pickle.loads(job)
+
+
+def _merge_chunk(start, namespaces):
+    template, loader = _merge_job
+    try:
+        return start, [template.merge(namespace, loader)
+                       for namespace in namespaces], None
+    except Exception as e:
+        # returned rather than raised, as multiprocessing would replace the
+        # __cause__ of a TemplateExecutionError with the worker's traceback
+        return start, None, e
+
+
+def _merged(result):
+    start, outputs, error = result
+    if error is not None:
+        raise error
+    return outputs
 
 
 class TemplateError(Exception):
@@ -114,24 +446,77 @@ class TemplateExecutionError(TemplateError):
         cause, value, traceback = exc_info
         self.__cause__ = value
         self.element = element
-        self.start, self.end, self.filename = (element.start, element.end,
-                                               element.filename)
-        self.msg = "Error in template '%s' at position " \
-                   "%d-%d in expression: %s\n%s: %s" % \
-                   (self.filename, self.start, self.end,
-                    element.my_text(), cause.__name__, value)
+        self.cause_name = cause.__name__
+
+    # Where the error happened is only worked out if someone asks
+
+    @property
+    def start(self):
+        return self.element.start
+
+    @property
+    def end(self):
+        return self.element.end
+
+    @property
+    def filename(self):
+        return self.element.filename
+
+    @property
+    def msg(self):
+        return "Error in template '%s' at position " \
+               "%d-%d in expression: %s\n%s: %s" % \
+               (self.filename, self.start, self.end,
+                self.element.my_text(), self.cause_name, self.__cause__)
 
     def __str__(self):
         return self.msg
 
+    def __reduce__(self):
+        # the traceback is left behind, as it can't be pickled
+        return (TemplateExecutionError,
+                (self.element, (type(self.__cause__), self.__cause__, None)))
+
+
+# Names of the element methods which evaluate a statement of a template
+EVALUATING_METHODS = frozenset(['evaluate', 'evaluate_iter', 'evaluate_raw'])
+
+
+def failing_element(traceback):
+    """Returns the element being evaluated where traceback ends, or None.
+
+    Elements don't catch errors themselves, so this works it out afterwards
+    from the frames the error passed through: the innermost statement being
+    evaluated is either the self of an evaluate method or, in a function
+    made by the CodeGenerator, found from the line being run.
+    """
+    element = None
+    while traceback is not None:
+        frame = traceback.tb_frame
+        line_elements = frame.f_globals.get('_line_elements')
+        if line_elements is not None:
+            element = line_elements[traceback.tb_lineno - 1] or element
+        elif frame.f_code.co_name in EVALUATING_METHODS:
+            candidate = frame.f_locals.get('self')
+            if isinstance(candidate, _Element):
+                element = candidate
+        traceback = traceback.tb_next
+    return element
+
+
+def raise_execution_error(exc_info):
+    """Raises the error in exc_info as a TemplateExecutionError."""
+    element = failing_element(exc_info[2])
+    if element is None:
+        six.reraise(*exc_info)
+    six.reraise(TemplateExecutionError,
+                TemplateExecutionError(element, exc_info), exc_info[2])
+
 
 class TemplateSyntaxError(TemplateError):
     def __init__(self, element, expected):
         self.element = element
-        self.text_understood = element.full_text()[:element.end]
-        self.line = 1 + self.text_understood.count('\n')
-        self.column = len(
-            self.text_understood) - self.text_understood.rfind('\n')
+        self.expected = expected
         got = element.next_text()
         if len(got) > 40:
             got = got[:36] + ' ...'
@@ -139,6 +524,19 @@ class TemplateSyntaxError(TemplateError):
             self, "line %d, column %d: expected %s in %s, got: %s ..." %
             (self.line, self.column, expected, self.element_name(), got))
 
+    @property
+    def text_understood(self):
+        return self.element.full_text()[:self.element.end]
+
+    @property
+    def line(self):
+        return 1 + self.text_understood.count('\n')
+
+    @property
+    def column(self):
+        text_understood = self.text_understood
+        return len(text_understood) - text_understood.rfind('\n')
+
     def get_position_strings(self):
         error_line_start = 1 + self.text_understood.rfind('\n')
         if '\n' in self.element.next_text():
@@ -165,19 +563,104 @@ class NullLoader:
     def load_template(self, name):
         raise self.load_text(name)
 
+    def find_macro(self, name):
+        return None
+
 
 class CachingFileLoader:
-    def __init__(self, basedir, debugging=False):
+    """Loads templates from files below basedir, keeping them once parsed.
+
+    Parsed templates, and the text of included files, are kept in
+    TemplateCaches, which by default grow without bound; pass max_entries
+    and/or max_bytes to evict the least recently used entries of each
+    instead.  The loader may be shared between threads: a template that is
+    requested by several threads at once is parsed by only one of them
+    while the others wait for it.
+
+    A cached entry is checked against its file's modification time when
+    it is loaded, at most once every check_interval seconds; a
+    check_interval of None turns the checks off.  Alternatively, given a
+    watch_interval, a background thread checks all of the cached entries
+    that often and drops those that changed, so that loading never needs
+    to look at the file; call close() to stop it.
+
+    The macros defined in the templates named in macro_libraries, like
+    Velocity's velocimacro.library, can be called from every template
+    merged with this loader without being #parse'd; see add_macro_library.
+    """
+
+    def __init__(self, basedir, debugging=False, codegen=None, cache_dir=None,
+                 max_entries=None, max_bytes=None, check_interval=0,
+                 watch_interval=None, macro_libraries=()):
         self.basedir = basedir
-        self.known_templates = {}  # name -> (template, file_mod_time)
+        # name -> [template or text, file_mod_time, time_of_last_check]
+        self.template_cache = TemplateCache(max_entries, max_bytes)
+        self.text_cache = TemplateCache(max_entries, max_bytes)
+        self.check_interval = check_interval
         self.debugging = debugging
+        self.codegen = codegen
+        self.disk_cache = None
+        if cache_dir is not None:
+            self.disk_cache = DiskCache(cache_dir)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.closed = threading.Event()
+        self.watcher = None
+        self.watch_interval = watch_interval
+        if watch_interval is not None:
+            self.check_interval = None
+            self.start_watcher()
         if debugging:
             print("creating caching file loader with basedir:", basedir)
+        # macro name -> MacroDefinition, for every template
+        self.macros = {}
+        for name in macro_libraries:
+            self.add_macro_library(name)
+
+    @property
+    def known_templates(self):
+        """The cached templates, as name -> (template, file_mod_time).
+
+        A read-only view of template_cache, as this used to be a dict.
+        """
+        return _KnownTemplates(self.template_cache)
+
+    def __getstate__(self):
+        # The caches, lock and watcher belong to this process, so a copy
+        # (in a worker process, say) starts out with its own, empty ones
+        state = self.__dict__.copy()
+        for name in ('template_cache', 'text_cache', 'lock', 'hits',
+                     'misses', 'closed', 'watcher'):
+            del state[name]
+        maxsize = self.template_cache.maxsize
+        state['cache_limits'] = (self.template_cache.max_entries,
+                                 None if maxsize == float('inf') else maxsize)
+        return state
+
+    def __setstate__(self, state):
+        max_entries, max_bytes = state.pop('cache_limits')
+        self.__dict__.update(state)
+        self.template_cache = TemplateCache(max_entries, max_bytes)
+        self.text_cache = TemplateCache(max_entries, max_bytes)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.closed = threading.Event()
+        self.watcher = None
+        if self.watch_interval is not None:
+            self.start_watcher()
+
+    def start_watcher(self):
+        self.watcher = threading.Thread(target=self.watch,
+                                        args=(self.watch_interval,))
+        self.watcher.daemon = True
+        self.watcher.start()
 
     def filename_of(self, name):
         return os.path.join(self.basedir, name)
 
-    def load_text(self, name):
+    def read_text(self, name):
         if self.debugging:
             print("Loading text from", self.basedir, name)
         f = open(self.filename_of(name))
@@ -186,24 +669,327 @@ class CachingFileLoader:
         finally:
             f.close()
 
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': (self.template_cache.evictions +
+                                  self.text_cache.evictions),
+                    'entries': len(self.template_cache),
+                    'size': self.template_cache.currsize,
+                    'text_entries': len(self.text_cache),
+                    'text_size': self.text_cache.currsize}
+
+    def load_text(self, name):
+        return self.load_cached(self.text_cache, name,
+                                lambda name, filename, stat:
+                                self.read_text(name))
+
+    def template_text(self, name):
+        """Returns the text of the template name, to be parsed.
+
+        Loaders which read files their own way override load_text, and are
+        still used for templates; otherwise the file is read directly, as
+        the text of a parsed template needn't be cached as well.
+        """
+        load_text = self.load_text
+        if getattr(load_text, '__func__', None) is \
+                six.get_unbound_function(CachingFileLoader.load_text):
+            return self.read_text(name)
+        return load_text(name)
+
     def load_template(self, name):
         if self.debugging:
             print("Loading template...", name,)
-        mtime = os.path.getmtime(self.filename_of(name))
-        if name in self.known_templates:
-            template, prev_mtime = self.known_templates[name]
-            if mtime <= prev_mtime:
-                if self.debugging:
-                    print("loading parsed template from cache")
-                return template
-        if self.debugging:
-            print("loading text from disk")
-        template = Template(self.load_text(name), filename=name)
+        return self.load_cached(self.template_cache, name,
+                                self.parse_template)
+
+    def add_macro_library(self, name):
+        """Makes the macros defined in the template name global.
+
+        The library is parsed once, here, and its macros never enter the
+        namespace, so they cost nothing to register when templates are
+        merged.  A macro replaces any of the same name from an earlier
+        library.  Calls prefer macros defined in their own template, then
+        the libraries', and then those #parse'd into the namespace.
+        """
+        template = self.load_template(name)
         template.ensure_compiled()
-        self.known_templates[name] = (template, mtime)
+        for macro in template.root_element.macros.values():
+            self.macros[macro.macro_name.lower()] = macro
+
+    def find_macro(self, name):
+        """Returns the library macro called name (in lower case), or None."""
+        return self.macros.get(name)
+
+    def load_cached(self, cache, name, load):
+        filename = self.filename_of(name)
+        with self.lock:
+            cached = cache.get(name)
+            if cached is not None and not self.due_for_check(cached):
+                self.hits += 1
+                if self.debugging:
+                    print("loading", name, "from cache")
+                return cached[0]
+        stat = os.stat(filename)
+        mtime = stat.st_mtime
+        with self.lock:
+            cached = cache.get(name)
+            if cached is not None and mtime <= cached[1]:
+                cached[2] = time.time()
+                self.hits += 1
+                if self.debugging:
+                    print("loading", name, "from cache")
+                return cached[0]
+            self.misses += 1
+            pending = cache.loading.get(name)
+            waiting = pending is not None
+            if not waiting:
+                pending = cache.loading[name] = _PendingLoad()
+        if waiting:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+        try:
+            pending.value = load(name, filename, stat)
+        except BaseException as e:
+            pending.error = e
+            raise
+        finally:
+            with self.lock:
+                del cache.loading[name]
+                if pending.value is not None:
+                    cache[name] = [pending.value, mtime, time.time()]
+            pending.done.set()
+        return pending.value
+
+    def due_for_check(self, cached):
+        return (self.check_interval is not None and
+                time.time() >= cached[2] + self.check_interval)
+
+    def watch(self, interval):
+        while not self.closed.wait(interval):
+            self.drop_changed_entries(self.template_cache)
+            self.drop_changed_entries(self.text_cache)
+
+    def drop_changed_entries(self, cache):
+        with self.lock:
+            entries = list(cache.entries())
+        for name, cached in entries:
+            try:
+                changed = os.stat(self.filename_of(name)).st_mtime > cached[1]
+            except OSError:
+                changed = True
+            if changed:
+                with self.lock:
+                    if cache.peek(name) is cached:
+                        del cache[name]
+                if self.debugging:
+                    print("dropping changed file", name)
+
+    def close(self):
+        """Stops the background watcher, if there is one."""
+        self.closed.set()
+        if self.watcher is not None:
+            self.watcher.join()
+
+    def parse_template(self, name, filename, stat):
+        template = None
+        if self.disk_cache is not None:
+            template = self.disk_cache.load(filename, self.codegen)
+            if self.debugging and template is not None:
+                print("loading parsed template from disk cache")
+        if template is None:
+            if self.debugging:
+                print("loading text from disk")
+            template = Template(self.template_text(name), filename=name,
+                                codegen=self.codegen)
+            template.ensure_compiled()
+            if self.disk_cache is not None:
+                self.disk_cache.store(filename, stat, template, self.codegen)
         return template
 
 
+class _PendingLoad:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TemplateCache(LRUCache):
+    """Maps names to [template or text, ...] entries, least recently used
+    first out.
+
+    Either or both of max_entries and max_bytes (measured with
+    Template.approximate_size for templates) may be given; an entry bigger
+    than max_bytes on its own is not cached at all.  Not thread-safe by
+    itself.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        if max_bytes is None:
+            LRUCache.__init__(self, float('inf'))
+        else:
+            LRUCache.__init__(self, max_bytes, getsizeof=self.size_of)
+        self.max_entries = max_entries
+        self.evictions = 0
+        self.loading = {}  # name -> _PendingLoad, while being loaded
+
+    def peek(self, key):
+        """Returns the entry for key, if any, without marking it as used."""
+        if key in self:
+            return Cache.__getitem__(self, key)
+
+    def entries(self):
+        """Yields (key, entry) pairs without marking them as used."""
+        for key in list(self):
+            yield key, Cache.__getitem__(self, key)
+
+    @staticmethod
+    def size_of(entry):
+        value = entry[0]
+        if isinstance(value, Template):
+            return value.approximate_size()
+        return sys.getsizeof(value)
+
+    def __setitem__(self, key, value):
+        if self.max_entries is not None and key not in self:
+            while self and len(self) >= self.max_entries:
+                self.popitem()
+        try:
+            LRUCache.__setitem__(self, key, value)
+        except ValueError:
+            # too large to be cached
+            self.pop(key, None)
+
+    def popitem(self):
+        item = LRUCache.popitem(self)
+        self.evictions += 1
+        return item
+
+
+class _KnownTemplates(collections_abc.Mapping):
+    """A read-only view of a TemplateCache with (template, file_mod_time)
+    values."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __getitem__(self, name):
+        entry = self.cache.peek(name)
+        if entry is None:
+            raise KeyError(name)
+        return entry[0], entry[1]
+
+    def __iter__(self):
+        return iter(list(self.cache))
+
+    def __len__(self):
+        return len(self.cache)
+
+
+class DiskCache:
+    """Keeps parsed templates in files, to be shared between processes.
+
+    Each template is pickled to a file named after the path of its source,
+    along with the airspeed version and the source file's modification
+    time, size and content hash.  An entry is used while the version is the
+    same and either the time and size or, failing that, the content hash
+    still match the source file.  Unreadable entries are simply ignored.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path_of(self, filename):
+        key = os.path.abspath(filename).encode('utf-8')
+        return os.path.join(self.directory,
+                            hashlib.sha1(key).hexdigest() + '.pickle')
+
+    @staticmethod
+    def digest(content):
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        return hashlib.sha1(content).hexdigest()
+
+    def load(self, filename, codegen):
+        try:
+            entry = open(self.path_of(filename), 'rb')
+            try:
+                # unpickling from memory is much quicker than from a file
+                f = io.BytesIO(entry.read())
+            finally:
+                entry.close()
+        except (IOError, OSError):
+            return None
+        try:
+            header = pickle.load(f)
+            if (header['version'], header['filename'], header['codegen']) != \
+                    (__version__, os.path.abspath(filename), codegen):
+                return None
+            stat = os.stat(filename)
+            unchanged = (header['mtime'], header['size']) == \
+                (stat.st_mtime, stat.st_size)
+            if not unchanged:
+                source = open(filename)
+                try:
+                    if self.digest(source.read()) != header['digest']:
+                        return None
+                finally:
+                    source.close()
+            # the tree is thousands of small objects and none of them
+            # garbage, so collecting while creating them is wasted effort
+            gc_was_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                template = pickle.load(f)
+            finally:
+                if gc_was_enabled:
+                    gc.enable()
+        except Exception:
+            # a damaged entry, or one written by incompatible code
+            return None
+        if not unchanged:
+            # save checking the content hash next time
+            self.store(filename, stat, template, codegen)
+        return template
+
+    def store(self, filename, stat, template, codegen):
+        """Saves template, parsed from filename when it had the given stat."""
+        header = {'version': __version__,
+                  'filename': os.path.abspath(filename),
+                  'codegen': codegen,
+                  'mtime': stat.st_mtime,
+                  'size': stat.st_size,
+                  'digest': self.digest(template.content)}
+        try:
+            data = pickle.dumps(header, pickle.HIGHEST_PROTOCOL) + \
+                pickle.dumps(template, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            # the template still works, but say why it isn't cached
+            warnings.warn("cannot cache template '%s' on disk: %s" %
+                          (filename, e), RuntimeWarning)
+            return
+        temp_path = None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory)
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            # replace the entry atomically, as other processes may read it
+            getattr(os, 'replace', os.rename)(temp_path,
+                                              self.path_of(filename))
+        except (IOError, OSError):
+            # the cache is only an optimisation, so carry on without it
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
 class StoppableStream(six.StringIO):
     def __init__(self, buf=''):
         self.stop = False
@@ -214,17 +1000,78 @@ class StoppableStream(six.StringIO):
             six.StringIO.write(self, s)
 
 
+class OutputBuffer(object):
+    """Collects merged output, passing it on to fileobj in large chunks.
+
+    Templates write many small pieces of text, so instead of passing each
+    one on they are kept in a list until at least flush_size characters have
+    been written.  The chunk is then encoded, if an encoding is given as
+    binary files and sockets need, and written to fileobj, which can also be
+    a socket without a write() method.  Without a fileobj the output is kept
+    until getvalue() is called.
+    """
+    FLUSH_SIZE = 65536
+
+    def __init__(self, fileobj=None, flush_size=FLUSH_SIZE, encoding=None):
+        self.pieces = []
+        self.size = 0
+        self.flush_size = flush_size
+        self.encoding = encoding
+        if fileobj is None:
+            self.target = None
+            # nothing to flush to, so writing needn't count the output
+            self.write = self.pieces.append
+        else:
+            self.target = getattr(fileobj, 'write', None) or fileobj.sendall
+
+    def write(self, text):
+        self.pieces.append(text)
+        self.size += len(text)
+        if self.size >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if self.target is None or not self.pieces:
+            return
+        text = ''.join(self.pieces)
+        del self.pieces[:]
+        self.size = 0
+        if self.encoding is not None:
+            text = text.encode(self.encoding)
+        self.target(text)
+
+    def getvalue(self):
+        return ''.join(self.pieces)
+
+
 ###############################################################################
 # Internals
 ###############################################################################
 
-WHITESPACE_TO_END_OF_LINE = re.compile(r'[ \t\r]*\n(.*)', re.S)
+WHITESPACE_TO_END_OF_LINE = re.compile(r'[ \t\r]*\n', re.S)
+
+# Matches the '(.*)' or '(.*)$' with which patterns of user-defined directives
+# traditionally capture the remainder of the template
+TAIL_GROUP = re.compile(r'\(\.\*\)\$?$')
+_TAIL_CAPTURING_PATTERNS = {}
 
 
 class NoMatch(Exception):
     pass
 
 
+class ControlFlow(Exception):
+    """Unwinds evaluation up to the element handling a directive."""
+
+
+class Stop(ControlFlow):
+    """Raised by #stop to end the evaluation of the whole template."""
+
+
+class Break(ControlFlow):
+    """Raised by #break to leave the innermost #foreach, macro or template."""
+
+
 class LocalNamespace(dict):
     def __init__(self, parent):
         dict.__init__(self)
@@ -261,63 +1108,152 @@ class LocalNamespace(dict):
         return dict.__repr__(self) + '->' + repr(self.parent)
 
 
-class _Element:
-    def __init__(self, filename, text, start=0):
+_UNSET = object()
+
+
+class _Slotted(object):
+    """Pickles the __slots__ of its subclasses with every protocol, where
+    Python 2 would only do so with protocol 2 and above."""
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for klass in inspect.getmro(type(self)):
+            for name in klass.__dict__.get('__slots__', ()):
+                value = getattr(self, name, _UNSET)
+                if name not in state and value is not _UNSET:
+                    state[name] = value
+        state.update(getattr(self, '__dict__', ()))
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class _Source(_Slotted):
+    """The text elements are parsed from, shared by all of them."""
+    __slots__ = ('filename', 'text')
+
+    def __init__(self, filename, text):
+        if type(filename) is str:
+            # many templates and strings inside them share a filename
+            filename = intern(filename)
         self.filename = filename
-        self._full_text = text
+        self.text = text
+
+
+# For each class of element, the names in the __slots__ of its subclasses
+# of _Element other than its LINKS and ALIASES, and whether its instances have a
+# __dict__ as well
+_FIELD_NAMES = {}
+
+
+def field_names(cls):
+    try:
+        return _FIELD_NAMES[cls]
+    except KeyError:
+        names = []
+        for klass in reversed(inspect.getmro(cls)):
+            if klass is _Element or not issubclass(klass, _Element):
+                continue
+            for name in klass.__dict__.get('__slots__', ()):
+                if name not in names and name not in cls.LINKS and \
+                        name not in cls.ALIASES:
+                    names.append(name)
+        has_dict = any('__dict__' in klass.__dict__
+                       for klass in inspect.getmro(cls))
+        _FIELD_NAMES[cls] = fields = (tuple(names), has_dict)
+        return fields
+
+
+class _Element(_Slotted):
+    # Elements are kept in their thousands by template caches, so they have
+    # __slots__ instead of dicts; subclasses defined elsewhere needn't.
+    __slots__ = ('source', 'start', 'end')
+    # Attributes referring to elements elsewhere, rather than to children
+    LINKS = ()
+    # Attributes holding a method of a child, saving a lookup each time it
+    # is called; they are not pickled, but made again by set_aliases()
+    ALIASES = ()
+
+    def __init__(self, source, start=0):
+        self.source = source
         self.start = self.end = start
         self.parse()
 
+    @property
+    def filename(self):
+        return self.source.filename
+
     def next_text(self):
-        return self._full_text[self.end:]
+        return self.source.text[self.end:]
+
+    def next_text_startswith(self, prefix):
+        return self.source.text.startswith(prefix, self.end)
 
     def my_text(self):
-        return self._full_text[self.start:self.end]
+        return self.source.text[self.start:self.end]
 
     def full_text(self):
-        return self._full_text
+        return self.source.text
 
     def syntax_error(self, expected):
         return TemplateSyntaxError(self, expected)
 
     def identity_match(self, pattern):
-        m = pattern.match(self._full_text, self.end)
+        m = pattern.match(self.source.text, self.end)
         if not m:
             raise NoMatch()
-        self.end = m.start(pattern.groups)
-        return m.groups()[:-1]
+        return self.consume(pattern, m)
 
     def next_match(self, pattern):
-        m = pattern.match(self._full_text, self.end)
+        m = pattern.match(self.source.text, self.end)
         if not m:
             return False
-        self.end = m.start(pattern.groups)
-        return m.groups()[:-1]
+        return self.consume(pattern, m)
 
     def optional_match(self, pattern):
-        m = pattern.match(self._full_text, self.end)
+        m = pattern.match(self.source.text, self.end)
         if not m:
             return False
-        self.end = m.start(pattern.groups)
+        self.consume(pattern, m)
         return True
 
     def require_match(self, pattern, expected):
-        m = pattern.match(self._full_text, self.end)
+        m = pattern.match(self.source.text, self.end)
         if not m:
             raise self.syntax_error(expected)
-        self.end = m.start(pattern.groups)
-        return m.groups()[:-1]
+        return self.consume(pattern, m)
+
+    def consume(self, pattern, m):
+        """Moves past the text matched by pattern, returning its groups.
+
+        Patterns match only the text they are interested in, and parsing
+        continues from the end of the match.  Patterns written for older
+        versions capture the rest of the text in a final '(.*)' group, which
+        is still understood.
+        """
+        try:
+            tail_captured = _TAIL_CAPTURING_PATTERNS[pattern]
+        except KeyError:
+            tail_captured = bool(TAIL_GROUP.search(pattern.pattern))
+            _TAIL_CAPTURING_PATTERNS[pattern] = tail_captured
+        if tail_captured:
+            self.end = m.start(pattern.groups)
+            return m.groups()[:-1]
+        self.end = m.end()
+        return m.groups()
 
     def next_element(self, element_spec):
         if callable(element_spec):
-            element = element_spec(self.filename, self._full_text, self.end)
+            element = element_spec(self.source, self.end)
             self.end = element.end
             return element
         else:
             for element_class in element_spec:
                 try:
-                    element = element_class(self.filename, self._full_text,
-                                            self.end)
+                    element = element_class(self.source, self.end)
                 except NoMatch:
                     pass
                 else:
@@ -328,8 +1264,7 @@ class _Element:
     def require_next_element(self, element_spec, expected):
         if callable(element_spec):
             try:
-                element = element_spec(self.filename, self._full_text,
-                                       self.end)
+                element = element_spec(self.source, self.end)
             except NoMatch:
                 raise self.syntax_error(expected)
             else:
@@ -338,8 +1273,7 @@ class _Element:
         else:
             for element_class in element_spec:
                 try:
-                    element = element_class(self.filename, self._full_text,
-                                            self.end)
+                    element = element_class(self.source, self.end)
                 except NoMatch:
                     pass
                 else:
@@ -348,21 +1282,131 @@ class _Element:
             expected = ', '.join([cls.__name__ for cls in element_spec])
             raise self.syntax_error('one of: ' + expected)
 
-    def evaluate(self, *args):
-        try:
-            return self.evaluate_raw(*args)
-        except TemplateExecutionError:
-            raise
-        except:
-            exc_info = sys.exc_info()
-            six.reraise(TemplateExecutionError,
-                        TemplateExecutionError(self, exc_info), exc_info[2])
+    def fields(self):
+        """Returns the (name, value) of each attribute set on this element.
+
+        The source and position, which every element has, the LINKS and
+        the ALIASES are left out.
+        """
+        names, has_dict = field_names(self.__class__)
+        fields = []
+        for name in names:
+            value = getattr(self, name, _UNSET)
+            if value is not _UNSET:
+                fields.append((name, value))
+        if has_dict:
+            fields.extend(self.__dict__.items())
+        return fields
+
+    def __getstate__(self):
+        state = dict(self.fields())
+        for name in ('source', 'start', 'end') + self.LINKS:
+            state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        if self.ALIASES:
+            self.set_aliases()
+
+    def set_aliases(self):
+        pass
+
+    def child_elements(self):
+        """Yields the elements directly nested inside this one."""
+        for name, value in self.fields():
+            if isinstance(value, _Element):
+                yield value
+            elif type(value) is list:
+                for item in value:
+                    if isinstance(item, _Element):
+                        yield item
+            elif type(value) is dict:
+                for key, item in value.items():
+                    if isinstance(key, _Element):
+                        yield key
+                    if isinstance(item, _Element):
+                        yield item
+
+    def prepare(self, scopes, macros):
+        """Readies this element and those below it for merging, once parsed.
+
+        In one walk of the tree, the elements are optimized and their
+        references told where they will be found.  scopes lists, innermost
+        last, the names bound by each enclosing element that evaluates its
+        children in a LocalNamespace of its own; macros collects the #macro
+        definitions and calls.  Returns what to use in place of this element.
+        """
+        if self.__class__.__module__ != __name__:
+            # elements defined elsewhere may make namespaces of their own,
+            # and rely on their children's types
+            for child in self.child_elements():
+                child.prepare([], macros)
+            return self
+        # the elements here have no __dict__, so fields() isn't needed
+        for name in field_names(self.__class__)[0]:
+            value = getattr(self, name, None)
+            if isinstance(value, _Element):
+                setattr(self, name, value.prepare(scopes, macros))
+            elif type(value) is list:
+                value[:] = [item.prepare(scopes, macros)
+                            if isinstance(item, _Element) else item
+                            for item in value]
+            elif type(value) is dict:
+                prepared = {}
+                for key, item in value.items():
+                    if isinstance(key, _Element):
+                        key = key.prepare(scopes, macros)
+                    if isinstance(item, _Element):
+                        item = item.prepare(scopes, macros)
+                    prepared[key] = item
+                setattr(self, name, prepared)
+        return self.optimize()
+
+    def optimize(self):
+        """Simplifies this element, once those below it are prepared.
+
+        Returns what to use in place of this element: itself, or something
+        with the same evaluate or calculate method which does less work.
+        """
+        return self
+
+    def evaluate(self, stream, namespace, loader):
+        # Elements written for older versions implement evaluate_raw, which
+        # evaluate used to wrap with error reporting
+        self.evaluate_raw(stream, namespace, loader)
+
+    def evaluate_raw(self, stream, namespace, loader):
+        # ...and may call it on the elements inside them
+        if getattr(self.evaluate, '__func__', None) is \
+                six.get_unbound_function(_Element.evaluate):
+            raise NotImplementedError(
+                '%s implements neither evaluate nor evaluate_raw' %
+                self.__class__.__name__)
+        self.evaluate(stream, namespace, loader)
+
+    def generate(self, generator):
+        # Elements without a specialised translation are simply called
+        generator.statement(self, '%s(stream, namespace, loader)' %
+                            generator.constant(self.evaluate))
+
+    def evaluate_iter(self, stream, namespace, loader):
+        """Generator version of evaluate() used by Template.merge_iter.
+
+        It yields whenever output may have been written to the stream, so
+        that the output can be passed on before evaluation continues.
+        """
+        # Elements which don't contain blocks write all of their output at once
+        self.evaluate(stream, namespace, loader)
+        yield
 
 
 class Text(_Element):
+    __slots__ = ('text',)
     PLAIN = re.compile(
         r'((?:[^\\\$#]+|\\[\$#])+|\$[^!\{a-z0-9_]|\$$|#$'
-        r'|#[^\{\}a-zA-Z0-9#\*]+|\\.)(.*)$',
+        r'|#[^\{\}a-zA-Z0-9#\*]+|\\.)',
         re.S +
         re.I)
     ESCAPED_CHAR = re.compile(r'\\([\$#]\S+)')
@@ -375,28 +1419,30 @@ class Text(_Element):
 
         self.text = self.ESCAPED_CHAR.sub(unescape, text)
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def generate(self, generator):
+        generator.statement(self, 'write(%s)' % generator.constant(self.text))
+
+    def evaluate(self, stream, namespace, loader):
         stream.write(self.text)
 
 
-class FallthroughHashText(_Element):
+class FallthroughHashText(Text):
     """ Plain text starting with a # but which didn't match an earlier
     directive or macro.  The canonical example is an HTML color spec.
     Note that it MUST NOT match block-ending directives.
     """
+    __slots__ = ()
     # because of earlier elements, this will always start with a hash
-    PLAIN = re.compile(r'(\#(?!end|else|elseif|\{(?:end|else|elseif)\}))(.*)$',
+    PLAIN = re.compile(r'(\#(?!end|else|elseif|\{(?:end|else|elseif)\}))',
                        re.S)
 
     def parse(self):
         self.text, = self.identity_match(self.PLAIN)
 
-    def evaluate_raw(self, stream, namespace, loader):
-        stream.write(self.text)
-
 
 class IntegerLiteral(_Element):
-    INTEGER = re.compile(r'(-?\d+)(.*)', re.S)
+    __slots__ = ('value',)
+    INTEGER = re.compile(r'(-?\d+)', re.S)
 
     def parse(self):
         self.value, = self.identity_match(self.INTEGER)
@@ -405,9 +1451,13 @@ class IntegerLiteral(_Element):
     def calculate(self, namespace, loader):
         return self.value
 
+    def optimize(self):
+        return _Constant(self.value)
+
 
 class FloatingPointLiteral(_Element):
-    FLOAT = re.compile(r'(-?\d+\.\d+)(.*)', re.S)
+    __slots__ = ('value',)
+    FLOAT = re.compile(r'(-?\d+\.\d+)', re.S)
 
     def parse(self):
         self.value, = self.identity_match(self.FLOAT)
@@ -416,9 +1466,13 @@ class FloatingPointLiteral(_Element):
     def calculate(self, namespace, loader):
         return self.value
 
+    def optimize(self):
+        return _Constant(self.value)
+
 
 class BooleanLiteral(_Element):
-    BOOLEAN = re.compile(r'((?:true)|(?:false))(.*)', re.S | re.I)
+    __slots__ = ('value',)
+    BOOLEAN = re.compile(r'((?:true)|(?:false))', re.S | re.I)
 
     def parse(self):
         self.value, = self.identity_match(self.BOOLEAN)
@@ -427,9 +1481,13 @@ class BooleanLiteral(_Element):
     def calculate(self, namespace, loader):
         return self.value
 
+    def optimize(self):
+        return _Constant(self.value)
+
 
 class StringLiteral(_Element):
-    STRING = re.compile(r"'((?:\\['nrbt\\\\\\$]|[^'\\])*)'(.*)", re.S)
+    __slots__ = ('value',)
+    STRING = re.compile(r"'((?:\\['nrbt\\\\\\$]|[^'\\])*)'", re.S)
     ESCAPED_CHAR = re.compile(r"\\([nrbt'\\])")
 
     def parse(self):
@@ -453,23 +1511,39 @@ class StringLiteral(_Element):
     def calculate(self, namespace, loader):
         return self.value
 
+    def optimize(self):
+        return _Constant(self.value)
+
 
 class InterpolatedStringLiteral(StringLiteral):
-    STRING = re.compile(r'"((?:\\["nrbt\\\\\\$]|[^"\\])*)"(.*)', re.S)
+    __slots__ = ('block',)
+    STRING = re.compile(r'"((?:\\["nrbt\\\\\\$]|[^"\\])*)"', re.S)
     ESCAPED_CHAR = re.compile(r'\\([nrbt"\\])')
 
     def parse(self):
         StringLiteral.parse(self)
-        self.block = Block(self.filename, self.value, 0)
+        self.block = Block(_Source(self.filename, self.value))
 
     def calculate(self, namespace, loader):
-        output = StoppableStream()
-        self.block.evaluate(output, namespace, loader)
+        output = OutputBuffer()
+        try:
+            self.block.evaluate(output, namespace, loader)
+        except Stop:
+            # a #stop only ends the string, leaving the text before it
+            pass
         return output.getvalue()
 
+    def optimize(self):
+        if all(isinstance(child, Text) for child in self.block.children):
+            # no references or directives left to interpolate
+            return _Constant(''.join(child.text
+                                     for child in self.block.children))
+        return self
+
 
 class Range(_Element):
-    MIDDLE = re.compile(r'([ \t]*\.\.[ \t]*)(.*)$', re.S)
+    __slots__ = ('value1', 'value2')
+    MIDDLE = re.compile(r'([ \t]*\.\.[ \t]*)', re.S)
 
     def parse(self):
         self.value1 = self.next_element((FormalReference, IntegerLiteral))
@@ -483,9 +1557,13 @@ class Range(_Element):
             return range(value1, value2 - 1, -1)
         return range(value1, value2 + 1)
 
+    def optimize(self):
+        return _Constant.fold(self, (self.value1, self.value2))
+
 
 class ValueList(_Element):
-    COMMA = re.compile(r'\s*,\s*(.*)$', re.S)
+    __slots__ = ('values',)
+    COMMA = re.compile(r'\s*,\s*', re.S)
 
     def parse(self):
         self.values = []
@@ -502,32 +1580,118 @@ class ValueList(_Element):
     def calculate(self, namespace, loader):
         return [value.calculate(namespace, loader) for value in self.values]
 
+    def optimize(self):
+        return _Constant.fold(self, self.values)
+
+
+class _EmptyValues(object):
+    __slots__ = ()
 
-class _EmptyValues:
     def calculate(self, namespace, loader):
         return []
 
 
+class _Constant(_Slotted):
+    """Stands in for an element whose value never changes.
+
+    Lists and dicts are held by _CopiedConstants instead, see fold().
+    """
+    __slots__ = ('value',)
+    # Types of values that cannot be modified
+    SCALARS = (type(None), bool, float, complex, six.text_type, bytes, str) + \
+        six.integer_types
+
+    def __init__(self, value):
+        self.value = value
+
+    def calculate(self, namespace, loader):
+        return self.value
+
+    @classmethod
+    def can_hold(cls, value):
+        if isinstance(value, (list, tuple)):
+            return all(isinstance(item, cls.SCALARS) for item in value)
+        if isinstance(value, dict):
+            return all(isinstance(item, cls.SCALARS)
+                       for pair in value.items() for item in pair)
+        return isinstance(value, cls.SCALARS + (type(range(0)),))
+
+    @classmethod
+    def fold(cls, element, operands):
+        """Returns a constant for element if its operands are all constant.
+
+        Otherwise, or if calculating the value fails, the element is kept
+        so that it fails in the same way when the template is merged.
+        """
+        if not all(constant_value(operand) is not _NOT_CONSTANT
+                   for operand in operands):
+            return element
+        try:
+            value = element.calculate(None, None)
+        except Exception:
+            return element
+        if not cls.can_hold(value):
+            return element
+        if isinstance(value, (list, dict)):
+            return _CopiedConstant(value)
+        return cls(value)
+
+
+class _CopiedConstant(_Constant):
+    """A constant list or dict, copied for each use as templates may
+    change it."""
+    __slots__ = ()
+
+    def calculate(self, namespace, loader):
+        return self.value.copy() if isinstance(self.value, dict) \
+            else list(self.value)
+
+
+_NOT_CONSTANT = object()
+
+
+def constant_value(element):
+    """Returns the value of element if it is constant, else _NOT_CONSTANT."""
+    if isinstance(element, Value):
+        element = element.expression
+    if isinstance(element, _Constant):
+        return element.value
+    return _NOT_CONSTANT
+
+
 class ArrayLiteral(_Element):
-    START = re.compile(r'\[[ \t]*(.*)$', re.S)
-    END = re.compile(r'[ \t]*\](.*)$', re.S)
-    values = _EmptyValues()
+    __slots__ = ('values', 'calculate')
+    ALIASES = ('calculate',)
+    START = re.compile(r'\[[ \t]*', re.S)
+    END = re.compile(r'[ \t]*\]', re.S)
+    NO_VALUES = _EmptyValues()
 
     def parse(self):
         self.identity_match(self.START)
+        self.values = self.NO_VALUES
         try:
             self.values = self.next_element((Range, ValueList))
         except NoMatch:
             pass
         self.require_match(self.END, ']')
+        self.set_aliases()
+
+    def set_aliases(self):
         self.calculate = self.values.calculate
 
+    def optimize(self):
+        if isinstance(self.values, _Constant):
+            return self.values
+        self.set_aliases()
+        return self
+
 
 class DictionaryLiteral(_Element):
-    START = re.compile(r'{[ \t]*(.*)$', re.S)
-    END = re.compile(r'[ \t]*}(.*)$', re.S)
-    KEYVALSEP = re.compile(r'[ \t]*:[ \t]*(.*)$', re.S)
-    PAIRSEP = re.compile(r'[ \t]*,[ \t]*(.*)$', re.S)
+    __slots__ = ('local_data',)
+    START = re.compile(r'{[ \t]*', re.S)
+    END = re.compile(r'[ \t]*}', re.S)
+    KEYVALSEP = re.compile(r'[ \t]*:[ \t]*', re.S)
+    PAIRSEP = re.compile(r'[ \t]*,[ \t]*', re.S)
 
     def parse(self):
         self.identity_match(self.START)
@@ -553,59 +1717,87 @@ class DictionaryLiteral(_Element):
                 namespace, loader)
         return tmp
 
+    def optimize(self):
+        return _Constant.fold(self, [element for pair in self.local_data.items()
+                                     for element in pair])
+
 
 class Value(_Element):
+    __slots__ = ('expression', 'calculate')
+    ALIASES = ('calculate',)
+    # Maps the first character of a value to the elements which can start
+    # with it; filled in at the end of the module.
+    CANDIDATES = {}
+
     def parse(self):
-        self.expression = self.next_element(
-            (FormalReference,
-             FloatingPointLiteral,
-             IntegerLiteral,
-             StringLiteral,
-             InterpolatedStringLiteral,
-             ArrayLiteral,
-             DictionaryLiteral,
-             ParenthesizedExpression,
-             UnaryOperatorValue,
-             BooleanLiteral))
+        self.expression = self.next_element(self.candidates())
+        self.set_aliases()
 
-    def calculate(self, namespace, loader):
-        return self.expression.calculate(namespace, loader)
+    def set_aliases(self):
+        self.calculate = self.expression.calculate
+
+    def candidates(self):
+        char = self.source.text[self.end:self.end + 1]
+        try:
+            return self.CANDIDATES[char]
+        except KeyError:
+            if char.isdigit():
+                return (FloatingPointLiteral, IntegerLiteral)
+            if char.isspace():
+                return (UnaryOperatorValue,)
+            return ()
+
+    def optimize(self):
+        # Values stay, since expressions tell operands from results by type
+        self.set_aliases()
+        return self
 
 
 class NameOrCall(_Element):
-    NAME = re.compile(r'([a-zA-Z0-9_]+)(.*)$', re.S)
-    parameters = None
-    index = None
+    __slots__ = ('name', 'parameters', 'index', 'scope_depth', 'access_cache')
+    NAME = re.compile(r'([a-zA-Z0-9_]+)', re.S)
+    MAX_CACHED_TYPES = 8
 
     def parse(self):
+        self.parameters = self.index = None
+        # For a loop variable or macro argument, how many namespaces up from
+        # the current one it is bound; see bind()
+        self.scope_depth = None
+        # Which ways of finding the name are worth trying on objects of the
+        # types seen here so far: type -> (try_item, try_attribute)
+        self.access_cache = None
         self.name, = self.identity_match(self.NAME)
         if not is_valid_vtl_identifier(self.name):
             raise NoMatch('Invalid VTL identifier %s.' % self.name)
-        try:
+        if self.next_text_startswith('('):
             self.parameters = self.next_element(ParameterList)
-        except NoMatch:
+        elif self.next_text_startswith('['):
             try:
                 self.index = self.next_element(ArrayIndex)
             except NoMatch:
                 pass
 
+    def bind(self, scopes):
+        for depth, names in enumerate(reversed(scopes)):
+            if self.name in names:
+                self.scope_depth = depth
+                return
+
     def calculate(self, current_object, loader, top_namespace):
-        result = None
-        try:
-            result = current_object[self.name]
-        except (KeyError, TypeError, AttributeError):
-            pass
-        if result is None and not isinstance(current_object, LocalNamespace):
-            try:
-                result = getattr(current_object, self.name)
-            except AttributeError:
-                pass
+        result = _UNBOUND
+        if self.scope_depth is not None:
+            result = self.bound_value(current_object)
+        if result is _UNBOUND:
+            result = self.lookup(current_object)
         if result is None:
-            methods_for_type = __additional_methods__.get(current_object.__class__)
-            if methods_for_type and self.name in methods_for_type:
-                result = lambda *args: methods_for_type[self.name](current_object, *args)
-        if result is None:
-            return None  # TODO: an explicit 'not found' exception?
+            method = find_additional_method(current_object.__class__,
+                                            self.name)
+            if method is None:
+                return None  # TODO: an explicit 'not found' exception?
+            if self.parameters is not None:
+                return method(current_object, *self.parameters.calculate(
+                    top_namespace, loader))
+            result = functools.partial(method, current_object)
         if self.parameters is not None:
             result = result(*self.parameters.calculate(top_namespace, loader))
         elif self.index is not None:
@@ -623,9 +1815,65 @@ class NameOrCall(_Element):
                 result = None
         return result
 
+    def bound_value(self, namespace):
+        depth = self.scope_depth
+        try:
+            while depth:
+                namespace = namespace.parent
+                depth -= 1
+            return dict.get(namespace, self.name, _UNBOUND)
+        except (AttributeError, TypeError):
+            # not evaluated in the namespaces that the resolver expected
+            return _UNBOUND
+
+    def lookup(self, current_object):
+        try:
+            try_item, try_attribute = self.access_cache[type(current_object)]
+        except (KeyError, TypeError):
+            try_item, try_attribute = self.learn_access(type(current_object))
+        result = None
+        if try_item:
+            try:
+                result = current_object[self.name]
+            except (KeyError, TypeError, AttributeError):
+                pass
+        if result is None and try_attribute:
+            try:
+                result = getattr(current_object, self.name)
+            except AttributeError:
+                pass
+        return result
+
+    def learn_access(self, cls):
+        if cls in _BUILTIN_TYPES:
+            try_item = cls is dict
+            try_attribute = hasattr(cls, self.name)
+        else:
+            try_item = hasattr(cls, '__getitem__')
+            try_attribute = not issubclass(cls, LocalNamespace)
+        if self.access_cache is None:
+            self.access_cache = {}
+        if len(self.access_cache) < self.MAX_CACHED_TYPES:
+            self.access_cache[cls] = try_item, try_attribute
+        return try_item, try_attribute
+
+    def __getstate__(self):
+        state = _Element.__getstate__(self)
+        state['access_cache'] = None
+        return state
+
+
+_UNBOUND = object()
+# Types whose instances certainly never gain attributes, or items named by
+# strings (apart from dicts)
+_BUILTIN_TYPES = frozenset(
+    [type(None), bool, int, float, complex, list, tuple, dict, set,
+     frozenset, str, bytes, six.text_type] + list(six.integer_types))
+
 
 class SubExpression(_Element):
-    DOT = re.compile(r'\.(.*)', re.S)
+    __slots__ = ('expression',)
+    DOT = re.compile(r'\.', re.S)
 
     def parse(self):
         self.identity_match(self.DOT)
@@ -637,16 +1885,24 @@ class SubExpression(_Element):
             loader,
             global_namespace)
 
+    def prepare(self, scopes, macros):
+        # The name itself is looked up on an object, not in a namespace, but
+        # any parameters or index are evaluated in the namespace
+        self.expression = _Element.prepare(self.expression, scopes, macros)
+        return self
+
 
 class VariableExpression(_Element):
-    subexpression = None
+    __slots__ = ('part', 'subexpression')
 
     def parse(self):
         self.part = self.next_element(NameOrCall)
-        try:
-            self.subexpression = self.next_element(SubExpression)
-        except NoMatch:
-            pass
+        self.subexpression = None
+        if self.next_text_startswith('.'):
+            try:
+                self.subexpression = self.next_element(SubExpression)
+            except NoMatch:
+                pass
 
     def calculate(self, namespace, loader, global_namespace=None):
         if global_namespace is None:
@@ -659,15 +1915,22 @@ class VariableExpression(_Element):
                 global_namespace)
         return value
 
+    def prepare(self, scopes, macros):
+        _Element.prepare(self, scopes, macros)
+        self.part.bind(scopes)
+        return self
+
 
 class ParameterList(_Element):
-    START = re.compile(r'\(\s*(.*)$', re.S)
-    COMMA = re.compile(r'\s*,\s*(.*)$', re.S)
-    END = re.compile(r'\s*\)(.*)$', re.S)
-    values = _EmptyValues()
+    __slots__ = ('values',)
+    START = re.compile(r'\(\s*', re.S)
+    COMMA = re.compile(r'\s*,\s*', re.S)
+    END = re.compile(r'\s*\)', re.S)
+    NO_VALUES = _EmptyValues()
 
     def parse(self):
         self.identity_match(self.START)
+        self.values = self.NO_VALUES
         try:
             self.values = self.next_element(ValueList)
         except NoMatch:
@@ -679,9 +1942,9 @@ class ParameterList(_Element):
 
 
 class ArrayIndex(_Element):
-    START = re.compile(r'\[[ \t]*(.*)$', re.S)
-    END = re.compile(r'[ \t]*\](.*)$', re.S)
-    index = 0
+    __slots__ = ('index',)
+    START = re.compile(r'\[[ \t]*', re.S)
+    END = re.compile(r'[ \t]*\]', re.S)
 
     def parse(self):
         self.identity_match(self.START)
@@ -698,35 +1961,70 @@ class ArrayIndex(_Element):
         return result
 
 class AlternateValue(_Element):
-    START = re.compile(r'\|(.*)$', re.S)
+    __slots__ = ('expression', 'calculate')
+    ALIASES = ('calculate',)
+    START = re.compile(r'\|', re.S)
 
     def parse(self):
         self.identity_match(self.START)
         self.expression = self.require_next_element(Value, 'expression')
+        self.set_aliases()
+
+    def set_aliases(self):
         self.calculate = self.expression.calculate
 
+    def optimize(self):
+        self.set_aliases()
+        return self
+
 
 class FormalReference(_Element):
-    START = re.compile(r'\$(!?)(\{?)(.*)$', re.S)
-    CLOSING_BRACE = re.compile(r'\}(.*)$', re.S)
+    __slots__ = ('silent', 'expression', 'calculate', 'alternate')
+    ALIASES = ('calculate',)
+    START = re.compile(r'\$(!?)(\{?)', re.S)
+    CLOSING_BRACE = re.compile(r'\}', re.S)
 
     def parse(self):
         self.silent, braces = self.identity_match(self.START)
         try:
             self.expression = self.next_element(VariableExpression)
-            self.calculate = self.expression.calculate
         except NoMatch:
             self.expression = None
-            self.calculate = None
+        self.set_aliases()
         self.alternate = None
         if braces:
-          try:
+          if self.next_text_startswith('|'):
               self.alternate = self.next_element(AlternateValue)
-          except NoMatch:
-              pass
           self.require_match(self.CLOSING_BRACE, '}')
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def set_aliases(self):
+        self.calculate = None
+        if self.expression is not None:
+            self.calculate = self.expression.calculate
+
+    def generate(self, generator):
+        generator.statement(self)
+        if self.expression is None and self.alternate is None:
+            generator.line('write(%s)' % generator.constant(self.my_text()))
+            return
+        if self.expression is None:
+            generator.line('value = None')
+        else:
+            generator.line('value = %s(namespace, loader)' %
+                           generator.constant(self.expression.calculate))
+        generator.line('if value is None:')
+        if self.alternate is not None:
+            default = '%s(namespace, loader)' % generator.constant(
+                self.alternate.calculate)
+        elif self.silent and self.expression is not None:
+            default = "''"
+        else:
+            default = generator.constant(self.my_text())
+        generator.line('    value = ' + default)
+        generator.line('write(value if is_string(value) '
+                       'else text_type(value))')
+
+    def evaluate(self, stream, namespace, loader):
         value = None
         if self.expression is not None:
             value = self.expression.calculate(namespace, loader)
@@ -743,28 +2041,38 @@ class FormalReference(_Element):
             stream.write(six.text_type(value))
 
 
-class Null:
+class Null(object):
+    __slots__ = ()
+
     def evaluate(self, stream, namespace, loader):
         pass
 
+    def evaluate_iter(self, stream, namespace, loader):
+        return iter(())
+
 
 class Comment(_Element, Null):
+    __slots__ = ()
     COMMENT = re.compile(
-        '#(?:#.*?(?:\n|$)|\\*.*?\\*#(?:[ \t]*\n)?)(.*)$',
+        '#(?:#.*?(?:\n|$)|\\*.*?\\*#(?:[ \t]*\n)?)',
         re.M +
         re.S)
 
     def parse(self):
         self.identity_match(self.COMMENT)
 
+    def generate(self, generator):
+        pass
+
     def evaluate(self, *args):
         pass
 
 
 class BinaryOperator(_Element):
+    __slots__ = ('apply_to', 'precedence', 'decided_by')
     BINARY_OP = re.compile(
         r'\s*(>=|<=|<|==|!=|>|%|\|\||&&|or|and|\+|\-|\*|\/|\%|gt|lt|ne|eq|ge'
-        r'|le|not)\s*(.*)$',
+        r'|le|not)\s*',
         re.S)
     OPERATORS = {'>': operator.gt, 'gt': operator.gt,
                  '>=': operator.ge, 'ge': operator.ge,
@@ -773,10 +2081,8 @@ class BinaryOperator(_Element):
                  '==': operator.eq, 'eq': operator.eq,
                  '!=': operator.ne, 'ne': operator.ne,
                  '%': operator.mod,
-                 '||': lambda a, b: boolean_value(a) or boolean_value(b),
-                 '&&': lambda a, b: boolean_value(a) and boolean_value(b),
-                 'or': lambda a, b: boolean_value(a) or boolean_value(b),
-                 'and': lambda a, b: boolean_value(a) and boolean_value(b),
+                 '||': boolean_or, '&&': boolean_and,
+                 'or': boolean_or, 'and': boolean_and,
                  '+': operator.add,
                  '-': operator.sub,
                  '*': operator.mul,
@@ -793,10 +2099,20 @@ class BinaryOperator(_Element):
     # As far as I can tell, this is undocumented.
     # Note that this applies only to add, not to other operators
 
+    # Operators which only evaluate their second operand when they need to
+    SHORT_CIRCUIT = {'||': True, 'or': True, '&&': False, 'and': False}
+
     def parse(self):
         op_string, = self.identity_match(self.BINARY_OP)
         self.apply_to = self.OPERATORS[op_string]
         self.precedence = self.PRECEDENCE[op_string]
+        # the value of the first operand which settles the result, if any
+        self.decided_by = self.SHORT_CIRCUIT.get(op_string)
+
+    def operation(self, operand1, operand2):
+        if self.decided_by is None:
+            return _Operation(self.apply_to, operand1, operand2)
+        return _ShortCircuitOperation(self.decided_by, operand1, operand2)
 
     # This assumes that the self operator is "to the left"
     # of the argument, and thus gets higher precedence if they're
@@ -810,7 +2126,8 @@ class BinaryOperator(_Element):
 
 
 class UnaryOperatorValue(_Element):
-    UNARY_OP = re.compile(r'\s*(!|(?:not))\s*(.*)$', re.S)
+    __slots__ = ('value', 'op')
+    UNARY_OP = re.compile(r'\s*(!|(?:not))\s*', re.S)
     OPERATORS = {'!': operator.__not__, 'not': operator.__not__}
 
     def parse(self):
@@ -821,10 +2138,46 @@ class UnaryOperatorValue(_Element):
     def calculate(self, namespace, loader):
         return self.op(self.value.calculate(namespace, loader))
 
+    def optimize(self):
+        return _Constant.fold(self, [self.value])
+
+
+class _Operation(_Slotted):
+    """A binary operator applied to two operands, calculated in order."""
+    __slots__ = ('apply_to', 'operand1', 'operand2')
+
+    def __init__(self, apply_to, operand1, operand2):
+        self.apply_to = apply_to
+        self.operand1 = operand1
+        self.operand2 = operand2
+
+    def calculate(self, namespace, loader):
+        return self.apply_to(self.operand1.calculate(namespace, loader),
+                             self.operand2.calculate(namespace, loader))
+
+
+class _ShortCircuitOperation(_Slotted):
+    """An || or && operation, skipping the second operand when possible."""
+    __slots__ = ('decided_by', 'operand1', 'operand2')
+
+    def __init__(self, decided_by, operand1, operand2):
+        self.decided_by = decided_by
+        self.operand1 = operand1
+        self.operand2 = operand2
+
+    def calculate(self, namespace, loader):
+        value = boolean_value(self.operand1.calculate(namespace, loader))
+        if value is self.decided_by:
+            return value
+        return boolean_value(self.operand2.calculate(namespace, loader))
+
 
 # Note: there appears to be no way to differentiate a variable or
 # value from an expression, other than context.
 class Expression(_Element):
+    __slots__ = ('expression', 'calculate')
+    ALIASES = ('calculate',)
+
     def parse(self):
         self.expression = [self.next_element(Value)]
         while (True):
@@ -835,74 +2188,93 @@ class Expression(_Element):
                 self.expression.append(value)
             except NoMatch:
                 break
-
-    def calculate(self, namespace, loader):
-        if not self.expression or len(self.expression) == 0:
-            return False
-        # TODO: how does velocity deal with an empty condition expression?
-
-        opstack = []
-        valuestack = [self.expression[0]]
-        terms = self.expression[1:]
-
-        # use top of opstack on top 2 values of valuestack
-        def stack_calculate(ops, values, namespace, loader):
-            value2 = values.pop()
-            if isinstance(value2, Value):
-                value2 = value2.calculate(namespace, loader)
-            value1 = values.pop()
-            if isinstance(value1, Value):
-                value1 = value1.calculate(namespace, loader)
-            result = ops.pop().apply_to(value1, value2)
-            # TODO this doesn't short circuit -- does velocity?
-            # also note they're eval'd out of order
-            values.append(result)
-
-        while terms:
-            # next is a binary operator
-            if not opstack or terms[0].greater_precedence_than(opstack[-1]):
-                opstack.append(terms[0])
-                valuestack.append(terms[1])
-                terms = terms[2:]
-            else:
-                stack_calculate(opstack, valuestack, namespace, loader)
-
-        # now clean out the stacks
-        while opstack:
-            stack_calculate(opstack, valuestack, namespace, loader)
-
-        if len(valuestack) != 1:
-            print ("evaluation of expression in Condition.calculate "
-                   "is messed up: final length of stack is not one")
-            # TODO handle this officially
-
-        result = valuestack[0]
-        if isinstance(result, Value):
-            result = result.calculate(namespace, loader)
-        return result
+        self.calculate = self.operation_tree(fold=False).calculate
+
+    def set_aliases(self):
+        self.calculate = self.operation_tree(fold=True).calculate
+
+    def operation_tree(self, fold):
+        """Returns the values and operators arranged by precedence.
+
+        The result is the single Value, or the _Operation for the operator
+        applied last; with fold, operations on constants are calculated.
+        """
+        operators = []
+        operands = [self.expression[0]]
+
+        # apply the last operator to the last two operands
+        def reduce():
+            operand2 = operands.pop()
+            operand1 = operands.pop()
+            operation = operators.pop().operation(operand1, operand2)
+            if fold:
+                operation = _Constant.fold(operation, (operand1, operand2))
+            operands.append(operation)
+
+        for i in range(1, len(self.expression), 2):
+            operator = self.expression[i]
+            while operators and \
+                    not operator.greater_precedence_than(operators[-1]):
+                reduce()
+            operators.append(operator)
+            operands.append(self.expression[i + 1])
+        while operators:
+            reduce()
+        return operands[0]
+
+    def optimize(self):
+        tree = self.operation_tree(fold=True)
+        if isinstance(tree, _Constant):
+            return tree
+        if constant_value(tree) is not _NOT_CONSTANT:
+            return tree.expression
+        self.calculate = tree.calculate
+        return self
 
 
 class ParenthesizedExpression(_Element):
-    START = re.compile(r'\(\s*(.*)$', re.S)
-    END = re.compile(r'\s*\)(.*)$', re.S)
+    __slots__ = ('expression', 'calculate')
+    ALIASES = ('calculate',)
+    START = re.compile(r'\(\s*', re.S)
+    END = re.compile(r'\s*\)', re.S)
 
     def parse(self):
         self.identity_match(self.START)
-        expression = self.next_element(Expression)
+        self.expression = self.next_element(Expression)
         self.require_match(self.END, ')')
-        self.calculate = expression.calculate
+        self.set_aliases()
+
+    def set_aliases(self):
+        self.calculate = self.expression.calculate
+
+    def optimize(self):
+        if isinstance(self.expression, _Constant):
+            return self.expression
+        self.set_aliases()
+        return self
 
 
 class Condition(_Element):
+    __slots__ = ('expression', 'calculate')
+    ALIASES = ('calculate',)
+
     def parse(self):
-        expression = self.next_element(ParenthesizedExpression)
+        self.expression = self.next_element(ParenthesizedExpression)
         self.optional_match(WHITESPACE_TO_END_OF_LINE)
-        self.calculate = expression.calculate
+        self.set_aliases()
         # TODO do I need to do anything else here?
 
+    def set_aliases(self):
+        self.calculate = self.expression.calculate
+
+    def optimize(self):
+        self.set_aliases()
+        return self
+
 
 class End(_Element):
-    END = re.compile(r'#(?:end|\{end\})(.*)', re.I + re.S)
+    __slots__ = ()
+    END = re.compile(r'#(?:end|\{end\})', re.I + re.S)
 
     def parse(self):
         self.identity_match(self.END)
@@ -910,31 +2282,49 @@ class End(_Element):
 
 
 class ElseBlock(_Element):
-    START = re.compile(r'#(?:else|\{else\})(.*)$', re.S + re.I)
+    __slots__ = ('block', 'evaluate', 'evaluate_iter')
+    ALIASES = ('evaluate', 'evaluate_iter')
+    START = re.compile(r'#(?:else|\{else\})', re.S + re.I)
 
     def parse(self):
         self.identity_match(self.START)
         self.block = self.require_next_element(Block, 'block')
+        self.set_aliases()
+
+    def set_aliases(self):
         self.evaluate = self.block.evaluate
+        self.evaluate_iter = self.block.evaluate_iter
 
 
 class ElseifBlock(_Element):
-    START = re.compile(r'#elseif\b\s*(.*)$', re.S + re.I)
+    __slots__ = ('condition', 'block', 'calculate', 'evaluate', 'evaluate_iter')
+    ALIASES = ('calculate', 'evaluate', 'evaluate_iter')
+    START = re.compile(r'#elseif\b\s*', re.S + re.I)
 
     def parse(self):
         self.identity_match(self.START)
         self.condition = self.require_next_element(Condition, 'condition')
         self.block = self.require_next_element(Block, 'block')
+        self.set_aliases()
+
+    def set_aliases(self):
         self.calculate = self.condition.calculate
         self.evaluate = self.block.evaluate
+        self.evaluate_iter = self.block.evaluate_iter
+
+    def optimize(self):
+        self.set_aliases()
+        return self
 
 
 class IfDirective(_Element):
-    START = re.compile(r'#if\b\s*(.*)$', re.S + re.I)
-    else_block = Null()
+    __slots__ = ('condition', 'block', 'elseifs', 'else_block')
+    START = re.compile(r'#if\b\s*', re.S + re.I)
+    NO_ELSE_BLOCK = Null()
 
     def parse(self):
         self.identity_match(self.START)
+        self.else_block = self.NO_ELSE_BLOCK
         self.condition = self.next_element(Condition)
         self.block = self.require_next_element(Block, "block")
         self.elseifs = []
@@ -949,26 +2339,87 @@ class IfDirective(_Element):
             pass
         self.require_next_element(End, '#else, #elseif or #end')
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def generate(self, generator):
+        branches = [(self.condition, self.block)] + \
+            [(elseif.condition, elseif.block) for elseif in self.elseifs]
+        keyword = 'if'
+        for condition, block in branches:
+            # conditions are evaluated on behalf of the #if itself
+            generator.statement(self)
+            generator.line('%s %s(namespace, loader):' %
+                           (keyword, generator.constant(condition.calculate)))
+            generator.indented_block(block)
+            keyword = 'elif'
+        if self.else_branch() is not None:
+            generator.statement(self, 'else:')
+            generator.indented_block(self.else_branch())
+
+    def prepare(self, scopes, macros):
+        """Drops the branches whose conditions are constant.
+
+        The conditions are prepared first, so that blocks which can never
+        be merged are dropped without being prepared.
+        """
+        kept, taken = [], None
+        for branch in [self] + self.elseifs:
+            branch.condition = branch.condition.prepare(scopes, macros)
+            value = constant_value(branch.condition.expression)
+            if value is _NOT_CONSTANT:
+                kept.append(branch)
+            elif value:
+                # no later branch can be taken
+                taken = branch.block
+                break
+        for branch in kept:
+            branch.block = branch.block.prepare(scopes, macros)
+            if branch is not self:
+                branch.set_aliases()
+        if taken is not None:
+            self.else_block = taken.prepare(scopes, macros)
+        elif isinstance(self.else_block, _Element):
+            self.else_block = self.else_block.prepare(scopes, macros)
+        if not kept:
+            else_branch = self.else_branch()
+            return else_branch if else_branch is not None else Null()
+        self.condition, self.block = kept[0].condition, kept[0].block
+        self.elseifs = kept[1:]
+        return self
+
+    def else_branch(self):
+        """Returns the block to evaluate when no condition holds, if any."""
+        if isinstance(self.else_block, ElseBlock):
+            return self.else_block.block
+        if isinstance(self.else_block, Block):
+            return self.else_block
+        return None
+
+    def chosen_block(self, namespace, loader):
         if self.condition.calculate(namespace, loader):
-            self.block.evaluate(stream, namespace, loader)
-        else:
-            for elseif in self.elseifs:
-                if elseif.calculate(namespace, loader):
-                    elseif.evaluate(stream, namespace, loader)
-                    return
-            self.else_block.evaluate(stream, namespace, loader)
+            return self.block
+        for elseif in self.elseifs:
+            if elseif.calculate(namespace, loader):
+                return elseif
+        return self.else_block
+
+    def evaluate(self, stream, namespace, loader):
+        self.chosen_block(namespace, loader).evaluate(stream, namespace, loader)
+
+    def evaluate_iter(self, stream, namespace, loader):
+        block = self.chosen_block(namespace, loader)
+        for _ in block.evaluate_iter(stream, namespace, loader):
+            yield
 
 
 # This can't deal with assignments like
 # set($one.two().three = something)
 # yet
 class Assignment(_Element):
+    __slots__ = ('terms', 'value')
     START = re.compile(
-        r'\s*\(\s*\$([a-z_][a-z0-9_]*(?:\.[a-z_][a-z0-9_]*)*)\s*=\s*(.*)$',
+        r'\s*\(\s*\$([a-z_][a-z0-9_]*(?:\.[a-z_][a-z0-9_]*)*)\s*=\s*',
         re.S +
         re.I)
-    END = re.compile(r'\s*\)(?:[ \t]*\r?\n)?(.*)$', re.S + re.M)
+    END = re.compile(r'\s*\)(?:[ \t]*\r?\n)?', re.S + re.M)
 
     def parse(self):
         var_name, = self.identity_match(self.START)
@@ -976,7 +2427,7 @@ class Assignment(_Element):
         self.value = self.require_next_element(Expression, "expression")
         self.require_match(self.END, ')')
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def evaluate(self, stream, namespace, loader):
         val = self.value.calculate(namespace, loader)
         if len(self.terms) == 1:
             namespace.set_inherited(self.terms[0], val)
@@ -987,9 +2438,10 @@ class Assignment(_Element):
             cur[self.terms[-1]] = val
 
 class EvaluateDirective(_Element):
-    START = re.compile(r'#evaluate\b(.*)')
-    OPEN_PAREN = re.compile(r'[ \t]*\(\s*(.*)$', re.S)
-    CLOSE_PAREN = re.compile(r'[ \t]*\)(.*)$', re.S)
+    __slots__ = ('value',)
+    START = re.compile(r'#evaluate\b')
+    OPEN_PAREN = re.compile(r'[ \t]*\(\s*', re.S)
+    CLOSE_PAREN = re.compile(r'[ \t]*\)', re.S)
 
     def parse(self):
         self.identity_match(self.START)
@@ -997,16 +2449,18 @@ class EvaluateDirective(_Element):
         self.value = self.require_next_element(Value, 'value')
         self.require_match(self.CLOSE_PAREN, ')')
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def evaluate(self, stream, namespace, loader):
         val = self.value.calculate(namespace, loader)
-        Template(val, "#evaluate").merge_to(namespace, stream, loader)
+        Template.from_string_cached(val, "#evaluate").merge_to(
+            namespace, stream, loader)
 
 class MacroDefinition(_Element):
-    START = re.compile(r'#macro\b(.*)', re.S + re.I)
-    OPEN_PAREN = re.compile(r'[ \t]*\(\s*(.*)$', re.S)
-    NAME = re.compile(r'\s*([a-z][a-z_0-9]*)\b(.*)', re.S + re.I)
-    CLOSE_PAREN = re.compile(r'[ \t]*\)(.*)$', re.S)
-    ARG_NAME = re.compile(r'[, \t]+\$([a-z][a-z_0-9]*)(.*)$', re.S + re.I)
+    __slots__ = ('macro_name', 'macro_key', 'arg_names', 'block')
+    START = re.compile(r'#macro\b', re.S + re.I)
+    OPEN_PAREN = re.compile(r'[ \t]*\(\s*', re.S)
+    NAME = re.compile(r'\s*([a-z][a-z_0-9]*)\b', re.S + re.I)
+    CLOSE_PAREN = re.compile(r'[ \t]*\)', re.S)
+    ARG_NAME = re.compile(r'[, \t]+\$([a-z][a-z_0-9]*)', re.S + re.I)
     RESERVED_NAMES = (
         'if',
         'else',
@@ -1017,6 +2471,7 @@ class MacroDefinition(_Element):
         'parse',
         'include',
         'stop',
+        'break',
         'end')
 
     def parse(self):
@@ -1025,6 +2480,8 @@ class MacroDefinition(_Element):
         self.macro_name, = self.require_match(self.NAME, 'macro name')
         if self.macro_name.lower() in self.RESERVED_NAMES:
             raise self.syntax_error('non-reserved name')
+        # macros are kept in the namespace under this key
+        self.macro_key = '#' + self.macro_name.lower()
         self.arg_names = []
         while True:
             m = self.next_match(self.ARG_NAME)
@@ -1036,15 +2493,22 @@ class MacroDefinition(_Element):
         self.block = self.require_next_element(Block, 'block')
         self.require_next_element(End, 'block')
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def evaluate(self, stream, namespace, loader):
+        # Calls in this template are bound already (see
+        # TemplateBody.prepare), but other templates find it here
         global_ns = namespace.top()
-        macro_key = '#' + self.macro_name.lower()
-        if macro_key in global_ns:
-            raise Exception("cannot redefine macro {0}".format(macro_key))
+        if self.macro_key in global_ns:
+            raise Exception("cannot redefine macro {0}".format(self.macro_key))
 
-        global_ns[macro_key] = self
+        global_ns[self.macro_key] = self
 
-    def execute_macro(self, stream, namespace, arg_value_elements, loader):
+    def prepare(self, scopes, macros):
+        # The body is evaluated in the namespace of whichever call site
+        self.block = self.block.prepare([self.arg_names], macros)
+        macros.definitions.setdefault(self.macro_key, []).append(self)
+        return self
+
+    def macro_namespace(self, namespace, arg_value_elements, loader):
         if len(arg_value_elements) != len(self.arg_names):
             raise Exception(
                 "expected %d arguments, got %d" %
@@ -1054,19 +2518,34 @@ class MacroDefinition(_Element):
         macro_namespace = LocalNamespace(namespace)
         for arg_name, arg_value in zip(self.arg_names, arg_value_elements):
             macro_namespace[arg_name] = arg_value.calculate(namespace, loader)
-        self.block.evaluate(stream, macro_namespace, loader)
+        return macro_namespace
+
+    def execute_macro(self, stream, namespace, arg_value_elements, loader):
+        macro_namespace = self.macro_namespace(
+            namespace, arg_value_elements, loader)
+        try:
+            self.block.evaluate(stream, macro_namespace, loader)
+        except Break:
+            pass
 
 
 class MacroCall(_Element):
-    START = re.compile(r'#([a-z][a-z_0-9]*)\b(.*)', re.S + re.I)
-    OPEN_PAREN = re.compile(r'[ \t]*\(\s*(.*)$', re.S)
-    CLOSE_PAREN = re.compile(r'[ \t]*\)(.*)$', re.S)
-    SPACE_OR_COMMA = re.compile(r'\s*(?:,|\s)\s*(.*)$', re.S)
+    __slots__ = ('macro_name', 'macro_key', 'args', 'macro', 'arg_slots')
+    LINKS = ('macro',)
+    ALIASES = ('arg_slots',)
+    START = re.compile(r'#([a-z][a-z_0-9]*)\b', re.S + re.I)
+    OPEN_PAREN = re.compile(r'[ \t]*\(\s*', re.S)
+    CLOSE_PAREN = re.compile(r'[ \t]*\)', re.S)
+    SPACE_OR_COMMA = re.compile(r'\s*(?:,|\s)\s*', re.S)
 
     def parse(self):
         macro_name, = self.identity_match(self.START)
         self.macro_name = macro_name.lower()
+        self.macro_key = '#' + self.macro_name
         self.args = []
+        # the macro, if it is known when the template is parsed, and the
+        # names its arguments are given with how to calculate them
+        self.macro = self.arg_slots = None
         if self.macro_name in MacroDefinition.RESERVED_NAMES or \
                 self.macro_name.startswith('end'):
             raise NoMatch()
@@ -1085,18 +2564,67 @@ class MacroCall(_Element):
                 break
         self.require_match(self.CLOSE_PAREN, 'argument value or )')
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def prepare(self, scopes, macros):
+        _Element.prepare(self, scopes, macros)
+        macros.calls.append(self)
+        return self
+
+    def bind(self, macros):
+        macro = macros.get(self.macro_key)
+        # calls with the wrong number of arguments fail when made
+        if macro is not None and len(macro.arg_names) == len(self.args):
+            self.macro = macro
+            self.set_aliases()
+
+    def set_aliases(self):
+        self.arg_slots = None
+        if self.macro is not None:
+            self.arg_slots = [(name, arg.calculate) for name, arg
+                              in zip(self.macro.arg_names, self.args)]
+
+    def find_macro(self, namespace, loader):
+        if self.macro is not None:
+            return self.macro
+        # loaders written for older versions have no macro libraries
+        find_library_macro = getattr(loader, 'find_macro', None)
+        if find_library_macro is not None:
+            macro = find_library_macro(self.macro_name)
+            if macro is not None:
+                return macro
         try:
-            macro = namespace['#' + self.macro_name]
+            return namespace[self.macro_key]
         except KeyError:
             raise Exception('no such macro: ' + self.macro_name)
-        macro.execute_macro(stream, namespace, self.args, loader)
+
+    def evaluate(self, stream, namespace, loader):
+        macro = self.macro
+        if macro is None:
+            macro = self.find_macro(namespace, loader)
+            macro.execute_macro(stream, namespace, self.args, loader)
+            return
+        macro_namespace = LocalNamespace(namespace)
+        for name, calculate in self.arg_slots:
+            macro_namespace[name] = calculate(namespace, loader)
+        try:
+            macro.block.evaluate(stream, macro_namespace, loader)
+        except Break:
+            pass
+
+    def evaluate_iter(self, stream, namespace, loader):
+        macro = self.find_macro(namespace, loader)
+        macro_namespace = macro.macro_namespace(namespace, self.args, loader)
+        try:
+            for _ in macro.block.evaluate_iter(stream, macro_namespace, loader):
+                yield
+        except Break:
+            pass
 
 
 class IncludeDirective(_Element):
-    START = re.compile(r'#include\b(.*)', re.S + re.I)
-    OPEN_PAREN = re.compile(r'[ \t]*\(\s*(.*)$', re.S)
-    CLOSE_PAREN = re.compile(r'[ \t]*\)(.*)$', re.S)
+    __slots__ = ('name',)
+    START = re.compile(r'#include\b', re.S + re.I)
+    OPEN_PAREN = re.compile(r'[ \t]*\(\s*', re.S)
+    CLOSE_PAREN = re.compile(r'[ \t]*\)', re.S)
 
     def parse(self):
         self.identity_match(self.START)
@@ -1108,14 +2636,15 @@ class IncludeDirective(_Element):
             'template name')
         self.require_match(self.CLOSE_PAREN, ')')
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def evaluate(self, stream, namespace, loader):
         stream.write(loader.load_text(self.name.calculate(namespace, loader)))
 
 
 class ParseDirective(_Element):
-    START = re.compile(r'#parse\b(.*)', re.S + re.I)
-    OPEN_PAREN = re.compile(r'[ \t]*\(\s*(.*)$', re.S)
-    CLOSE_PAREN = re.compile(r'[ \t]*\)(.*)$', re.S)
+    __slots__ = ('name',)
+    START = re.compile(r'#parse\b', re.S + re.I)
+    OPEN_PAREN = re.compile(r'[ \t]*\(\s*', re.S)
+    CLOSE_PAREN = re.compile(r'[ \t]*\)', re.S)
 
     def parse(self):
         self.identity_match(self.START)
@@ -1127,51 +2656,73 @@ class ParseDirective(_Element):
             'template name')
         self.require_match(self.CLOSE_PAREN, ')')
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def evaluate(self, stream, namespace, loader):
         template = loader.load_template(self.name.calculate(namespace, loader))
         # TODO: local namespace?
         template.merge_to(namespace, stream, loader=loader)
 
+    def evaluate_iter(self, stream, namespace, loader):
+        template = loader.load_template(self.name.calculate(namespace, loader))
+        template.ensure_compiled()
+        for _ in template.root_element.evaluate_iter(stream, namespace, loader):
+            yield
+
 
 class StopDirective(_Element):
-    STOP = re.compile(r'#stop\b(.*)', re.S + re.I)
+    __slots__ = ()
+    STOP = re.compile(r'#stop\b', re.S + re.I)
 
     def parse(self):
         self.identity_match(self.STOP)
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def evaluate(self, stream, namespace, loader):
         if hasattr(stream, 'stop'):
             stream.stop = True
+        raise Stop()
+
+
+class BreakDirective(_Element):
+    __slots__ = ()
+    BREAK = re.compile(r'#break\b', re.S + re.I)
+
+    def parse(self):
+        self.identity_match(self.BREAK)
+
+    def evaluate(self, stream, namespace, loader):
+        raise Break()
 
 
 # Represents a SINGLE user-defined directive
 class UserDefinedDirective(_Element):
+    __slots__ = ('directive',)
     DIRECTIVES = []
 
     def parse(self):
         self.directive = self.next_element(self.DIRECTIVES)
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def evaluate(self, stream, namespace, loader):
         self.directive.evaluate(stream, namespace, loader)
 
 
 class SetDirective(_Element):
-    START = re.compile(r'#set\b(.*)', re.S + re.I)
+    __slots__ = ('assignment',)
+    START = re.compile(r'#set\b', re.S + re.I)
 
     def parse(self):
         self.identity_match(self.START)
         self.assignment = self.require_next_element(Assignment, 'assignment')
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def evaluate(self, stream, namespace, loader):
         self.assignment.evaluate(stream, namespace, loader)
 
 
 class ForeachDirective(_Element):
-    START = re.compile(r'#foreach\b(.*)$', re.S + re.I)
-    OPEN_PAREN = re.compile(r'[ \t]*\(\s*(.*)$', re.S)
-    IN = re.compile(r'[ \t]+in[ \t]+(.*)$', re.S)
-    LOOP_VAR_NAME = re.compile(r'\$([a-z_][a-z0-9_]*)(.*)$', re.S + re.I)
-    CLOSE_PAREN = re.compile(r'[ \t]*\)(.*)$', re.S)
+    __slots__ = ('loop_var_name', 'value', 'block')
+    START = re.compile(r'#foreach\b', re.S + re.I)
+    OPEN_PAREN = re.compile(r'[ \t]*\(\s*', re.S)
+    IN = re.compile(r'[ \t]+in[ \t]+', re.S)
+    LOOP_VAR_NAME = re.compile(r'\$([a-z_][a-z0-9_]*)', re.S + re.I)
+    CLOSE_PAREN = re.compile(r'[ \t]*\)', re.S)
 
     def parse(self):
         # Could be cleaner b/c syntax error if no '('
@@ -1185,75 +2736,676 @@ class ForeachDirective(_Element):
         self.block = self.next_element(Block)
         self.require_next_element(End, '#end')
 
-    def evaluate_raw(self, stream, namespace, loader):
-        iterable = self.value.calculate(namespace, loader)
-        counter = 1
+    def prepare(self, scopes, macros):
+        self.value = self.value.prepare(scopes, macros)
+        self.block = self.block.prepare(scopes + [(
+            self.loop_var_name, 'foreach', 'velocityCount', 'velocityHasNext')],
+            macros)
+        return self
+
+    def evaluate(self, stream, namespace, loader):
         try:
-            if iterable is None:
-                return
-            if hasattr(iterable, 'keys'):
-                iterable = iterable.keys()
-            try:
-                iter(iterable)
-            except TypeError:
-                raise ValueError(
-                    "value for $%s is not iterable in #foreach: %s" %
-                    (self.loop_var_name, iterable))
-            length = len(iterable)
-            for item in iterable:
-                localns = LocalNamespace(namespace)
-                localns['velocityCount'] = counter
-                localns['velocityHasNext'] = counter < length
-                localns['foreach'] = {
-                    "count": counter,
-                    "index": counter - 1,
-                    "hasNext": counter < length,
-                    "first": counter == 1,
-                    "last": counter == length}
-                localns[self.loop_var_name] = item
+            for localns in self.iterations(namespace, loader):
                 self.block.evaluate(stream, localns, loader)
-                counter += 1
+        except Break:
+            pass
+
+    def evaluate_iter(self, stream, namespace, loader):
+        try:
+            for localns in self.iterations(namespace, loader):
+                for _ in self.block.evaluate_iter(stream, localns, loader):
+                    yield
+        except Break:
+            pass
+
+    def iterations(self, namespace, loader):
+        """Yields the namespace for each pass through the loop body.
+
+        Any iterable will do, including generators: items are taken one
+        ahead of the loop body, to tell whether there is a next one.
+        """
+        iterable = self.value.calculate(namespace, loader)
+        if iterable is None:
+            return
+        if hasattr(iterable, 'keys'):
+            iterable = iterable.keys()
+        try:
+            items = iter(iterable)
         except TypeError:
-            raise
+            raise ValueError(
+                "value for $%s is not iterable in #foreach: %s" %
+                (self.loop_var_name, iterable))
+        following = next(items, _END_OF_ITEMS)
+        # The same namespace and $foreach are used for every iteration
+        localns = LocalNamespace(namespace)
+        frame = ForeachFrame()
+        size = None
+        counter = 1
+        while following is not _END_OF_ITEMS:
+            item = following
+            following = next(items, _END_OF_ITEMS)
+            frame.count = counter
+            frame.hasNext = following is not _END_OF_ITEMS
+            if len(localns) != size:
+                # forget whatever the previous iteration #set
+                localns.clear()
+            localns['velocityCount'] = counter
+            localns['velocityHasNext'] = frame.hasNext
+            localns['foreach'] = frame
+            localns[self.loop_var_name] = item
+            size = len(localns)
+            yield localns
+            counter += 1
+
+
+_END_OF_ITEMS = object()
+
+
+class ForeachFrame(_Slotted, collections_abc.Mapping):
+    """The value of $foreach: how far through its loop a #foreach is.
+
+    It is a read-only mapping, as $foreach used to be a dict.
+    """
+    __slots__ = ('count', 'hasNext')
+    KEYS = ('count', 'index', 'hasNext', 'first', 'last')
+
+    index = property(lambda self: self.count - 1)
+    first = property(lambda self: self.count == 1)
+    last = property(lambda self: not self.hasNext)
+
+    def __getitem__(self, key):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class _MacroSites(object):
+    """The #macro definitions and calls found while preparing a template."""
+
+    def __init__(self):
+        self.definitions = {}
+        self.calls = []
 
 
 class TemplateBody(_Element):
+    __slots__ = ('block', 'macros')
+    LINKS = ('macros',)
+
     def parse(self):
         self.block = self.next_element(Block)
-        if self.next_text():
+        if self.end < len(self.source.text):
             raise self.syntax_error('block element')
+        self.macros = {}
+
+    def prepare(self, scopes, macros):
+        """Prepares the template, then binds its #macro calls to the macros
+        defined in it.
+
+        Like Velocity, a template's macros can be called anywhere in it, so
+        calls needn't look them up in the namespace.  A macro defined more
+        than once is left to be found, or refused, when the template is
+        merged.  self.macros holds the macros found, by namespace key.
+        """
+        self.block = self.block.prepare(scopes, macros)
+        self.macros = dict((key, found[0])
+                           for key, found in macros.definitions.items()
+                           if len(found) == 1)
+        for call in macros.calls:
+            call.bind(self.macros)
+        return self
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def evaluate(self, stream, namespace, loader):
         # Use the same namespace as the parent template, if sub-template
         if not isinstance(namespace, LocalNamespace):
             namespace = LocalNamespace(namespace)
-        self.block.evaluate(stream, namespace, loader)
+        try:
+            self.block.evaluate(stream, namespace, loader)
+        except Break:
+            pass
+
+    def evaluate_iter(self, stream, namespace, loader):
+        if not isinstance(namespace, LocalNamespace):
+            namespace = LocalNamespace(namespace)
+        try:
+            for _ in self.block.evaluate_iter(stream, namespace, loader):
+                yield
+        except Break:
+            pass
 
 
 class Block(_Element):
+    __slots__ = ('children', 'compiled')
+    # A '$' or '#' starting plain text rather than a reference or directive
+    DOLLAR_TEXT = re.compile(r'\$(?:[^!\{a-z0-9_]|$)', re.S + re.I)
+    HASH_TEXT = re.compile(r'#(?:[^\{\}a-zA-Z0-9#\*]|$)', re.S + re.I)
+    HASH_NAME = re.compile(r'#([a-z][a-z_0-9]*)', re.I)
+    # Candidate children for '#' followed by these (lower-cased) names,
+    # filled in at the end of the module
+    DIRECTIVE_CANDIDATES = {}
+    BLOCK_ENDS = ('end', 'else', 'elseif')
+
     def parse(self):
+        # set by CodeGenerator.compile_blocks
+        self.compiled = None
         self.children = []
         while True:
             try:
-                self.children.append(
-                    self.next_element(
-                        (Text,
-                         FormalReference,
-                         Comment,
-                         IfDirective,
-                         SetDirective,
-                         ForeachDirective,
-                         IncludeDirective,
-                         ParseDirective,
-                         MacroDefinition,
-                         StopDirective,
-                         UserDefinedDirective,
-                         EvaluateDirective,
-                         MacroCall,
-                         FallthroughHashText)))
+                self.children.append(self.next_element(self.candidates()))
             except NoMatch:
                 break
 
-    def evaluate_raw(self, stream, namespace, loader):
+    def candidates(self):
+        """Returns the kinds of element the next child could be.
+
+        They are a subset of, and in the same order as, the elements in
+        PRECEDENCE, chosen by looking at the text starting the child.
+        """
+        text, pos = self.source.text, self.end
+        char = text[pos:pos + 1]
+        if char == '$':
+            if self.DOLLAR_TEXT.match(text, pos):
+                return (Text,)
+            return (FormalReference,)
+        if char == '#':
+            if self.HASH_TEXT.match(text, pos):
+                return (Text,)
+            m = self.HASH_NAME.match(text, pos)
+            if m:
+                name = m.group(1)
+                if name in self.BLOCK_ENDS:
+                    return (UserDefinedDirective,)
+                return self.DIRECTIVE_CANDIDATES.get(
+                    name.lower(), self.OTHER_HASH_CANDIDATES)
+            if text[pos + 1:pos + 2] in ('#', '*'):
+                return (Comment, UserDefinedDirective, FallthroughHashText)
+            return (UserDefinedDirective, FallthroughHashText)
+        if char:
+            return (Text,)
+        return ()
+
+    def __getstate__(self):
+        state = _Element.__getstate__(self)
+        state['compiled'] = CodeGenerator.pickled_code(self.compiled)
+        return state
+
+    def __setstate__(self, state):
+        _Element.__setstate__(self, state)
+        self.compiled = CodeGenerator.unpickled_code(self.compiled)
+
+    def optimize(self):
+        """Joins up adjacent text, leaving out comments and empty #ifs."""
+        children = []
+        for child in self.children:
+            # Blocks are left in place of #ifs with constant conditions
+            for child in (child.children if isinstance(child, Block)
+                          else [child]):
+                if isinstance(child, Null):
+                    continue
+                if isinstance(child, Text) and children and \
+                        isinstance(children[-1], Text):
+                    children[-1].text += child.text
+                    children[-1].end = child.end
+                else:
+                    children.append(child)
+        self.children = children
+        return self
+
+    def generate(self, generator):
+        for child in self.children:
+            child.generate(generator)
+
+    def evaluate(self, stream, namespace, loader):
+        if self.compiled is not None:
+            return self.compiled(stream, namespace, loader)
         for child in self.children:
             child.evaluate(stream, namespace, loader)
+
+    def evaluate_iter(self, stream, namespace, loader):
+        for child in self.children:
+            for _ in child.evaluate_iter(stream, namespace, loader):
+                yield
+
+
+Template.string_cache = TemplateCache(max_entries=1000)
+Template.string_cache_lock = threading.Lock()
+
+
+###############################################################################
+# Parser dispatch tables
+###############################################################################
+
+Value.CANDIDATES.update({
+    '$': (FormalReference,),
+    '-': (FloatingPointLiteral, IntegerLiteral),
+    "'": (StringLiteral,),
+    '"': (InterpolatedStringLiteral,),
+    '[': (ArrayLiteral,),
+    '{': (DictionaryLiteral,),
+    '(': (ParenthesizedExpression,),
+    '!': (UnaryOperatorValue,),
+    'n': (UnaryOperatorValue,),
+    't': (BooleanLiteral,),
+    'T': (BooleanLiteral,),
+    'f': (BooleanLiteral,),
+    'F': (BooleanLiteral,)})
+
+# Every kind of element a block can contain, in the order they are tried
+Block.PRECEDENCE = (
+    Text,
+    FormalReference,
+    Comment,
+    IfDirective,
+    SetDirective,
+    ForeachDirective,
+    IncludeDirective,
+    ParseDirective,
+    MacroDefinition,
+    StopDirective,
+    BreakDirective,
+    UserDefinedDirective,
+    EvaluateDirective,
+    MacroCall,
+    FallthroughHashText)
+# A '#' followed by a name can only be a directive of that name, a
+# user-defined directive, a macro call or plain text
+Block.OTHER_HASH_CANDIDATES = (
+    UserDefinedDirective, MacroCall, FallthroughHashText)
+for name, directive in [('if', IfDirective),
+                        ('set', SetDirective),
+                        ('foreach', ForeachDirective),
+                        ('include', IncludeDirective),
+                        ('parse', ParseDirective),
+                        ('macro', MacroDefinition),
+                        ('stop', StopDirective),
+                        ('break', BreakDirective),
+                        ('evaluate', EvaluateDirective)]:
+    Block.DIRECTIVE_CANDIDATES[name] = tuple(
+        [cls for cls in Block.PRECEDENCE
+         if cls is directive or cls in Block.OTHER_HASH_CANDIDATES])
+del name, directive
+
+
+###############################################################################
+# Code generation
+###############################################################################
+
+class CodeGenerator:
+    """Translates a Block into the source of an equivalent Python function.
+
+    Text is written directly, references and conditions are calculated inline
+    and anything else calls back into the element tree, so the generated
+    function does the same work as Block.evaluate without dispatching
+    through evaluate() for every child.  Errors are still reported against
+    the element being evaluated when they happened, which is found from the
+    line that failed.
+    """
+
+    MAX_FUNCTION_ELEMENTS = 200
+
+    def __init__(self):
+        self.lines = []
+        self.line_elements = []
+        self.constants = []
+        self.element = None
+        self.indent = 2
+
+    @classmethod
+    def compile_blocks(cls, root_element):
+        """Compiles every Block in the tree under root_element."""
+        pending, seen = [root_element], set()
+        while pending:
+            element = pending.pop()
+            if id(element) in seen:
+                continue
+            seen.add(id(element))
+            if isinstance(element, IfDirective):
+                # the branches are generated inline with the #if itself
+                inlined = [element.block] + \
+                    [elseif.block for elseif in element.elseifs]
+                if element.else_branch() is not None:
+                    inlined.append(element.else_branch())
+                for block in inlined:
+                    seen.add(id(block))
+                    pending.extend(block.child_elements())
+            elif isinstance(element, Block) and element.compiled is None:
+                element.compiled = cls.compile_block(element)
+            pending.extend(element.child_elements())
+
+    @classmethod
+    def compile_block(cls, block):
+        """Returns a function(stream, namespace, loader) rendering block."""
+        # Python compiles very long functions slowly, so long blocks are
+        # split into several functions called one after the other
+        children = block.children
+        size = cls.MAX_FUNCTION_ELEMENTS
+        return cls.render_parts([cls().compile(block.filename,
+                                               children[i:i + size])
+                                 for i in range(0, max(len(children), 1),
+                                                size)])
+
+    @staticmethod
+    def function(code, constants, line_elements):
+        # failing_element() looks up the element of a failing line here
+        scope = {'_line_elements': line_elements,
+                 'is_string': is_string, 'text_type': six.text_type}
+        exec(code, scope)
+        return scope['make'](constants)
+
+    @classmethod
+    def render_parts(cls, parts):
+        """Returns a function calling those made from each compiled part."""
+        functions = [cls.function(*part) for part in parts]
+        if len(functions) == 1:
+            render = functions[0]
+        else:
+            def render(stream, namespace, loader):
+                for function in functions:
+                    function(stream, namespace, loader)
+        # kept for pickled_code()
+        render.parts = parts
+        return render
+
+    @staticmethod
+    def pickled_code(render):
+        """Returns what to pickle in place of a function from render_parts.
+
+        Functions cannot be pickled, but their code can be marshalled, for
+        the version of Python with the same magic number to load.
+        """
+        parts = getattr(render, 'parts', None)
+        if parts is None:
+            return None
+        return (CODE_MAGIC_NUMBER,
+                [(marshal.dumps(code), [_PickledMethod.of(constant)
+                                        for constant in constants],
+                  line_elements)
+                 for code, constants, line_elements in parts])
+
+    @classmethod
+    def unpickled_code(cls, pickled):
+        """Returns the function pickled by pickled_code, if it can."""
+        if pickled is None or pickled[0] != CODE_MAGIC_NUMBER:
+            # compile_blocks generates the code again
+            return None
+        return cls.render_parts([
+            (marshal.loads(code), [_PickledMethod.resolve(constant)
+                                   for constant in constants],
+             line_elements)
+            for code, constants, line_elements in pickled[1]])
+
+    def constant(self, value):
+        self.constants.append(value)
+        return '_k%d' % (len(self.constants) - 1)
+
+    def line(self, code):
+        self.lines.append('    ' * self.indent + code)
+        self.line_elements.append(self.element)
+
+    def statement(self, element, code=None):
+        # The lines which follow are run on behalf of element
+        self.element = element
+        if code is not None:
+            self.line(code)
+
+    def indented_block(self, block):
+        self.indent += 1
+        length = len(self.lines)
+        block.generate(self)
+        if len(self.lines) == length:
+            self.line('pass')
+        self.indent -= 1
+
+    def source(self, elements):
+        for element in elements:
+            element.generate(self)
+        names = ''.join(['_k%d,' % i for i in range(len(self.constants))])
+        return '\n'.join([
+            'def make(_constants):',
+            '    %s = _constants' % (names or '_'),
+            '    def render(stream, namespace, loader):',
+            '        write = stream.write'] +
+            (self.lines or ['        pass']) + [
+            '    return render'])
+
+    def compile(self, filename, elements):
+        """Returns the code, constants and elements of each line of a
+        function evaluating elements, as function() takes them."""
+        source = self.source(elements)
+        code = compile(source, '<airspeed %s>' % filename, 'exec')
+        # self.lines start on the fifth line of the source
+        return code, self.constants, [None] * 4 + self.line_elements
+
+
+class _PickledMethod(_Slotted):
+    """A method of an element, as a constant of pickled generated code.
+
+    Python 2 cannot pickle methods, so the object and name are pickled.
+    """
+    __slots__ = ('obj', 'name')
+
+    @classmethod
+    def of(cls, constant):
+        if not isinstance(constant, types.MethodType):
+            return constant
+        method = cls()
+        method.obj, method.name = constant.__self__, constant.__name__
+        return method
+
+    @staticmethod
+    def resolve(constant):
+        if isinstance(constant, _PickledMethod):
+            return getattr(constant.obj, constant.name)
+        return constant
+
+
+###############################################################################
+# Profiling
+###############################################################################
+
+class Profiler:
+    """Records where the time goes when templates are merged.
+
+    Set Template.profiler, or the profiler of a single template, to a
+    Profiler and every merge_to (and so merge) records, for each element
+    evaluated: how often, the time spent in it including and excluding the
+    elements inside it, and the characters of output written meanwhile.
+    Elements are identified by filename, line and their text, so figures
+    add up across merges and across templates parsed from the same file.
+    Nothing is recorded, or costs anything, while the profiler is None.
+
+    Profiling works through sys.setprofile, and is skipped for merges in
+    threads which are being profiled already.  With codegen, the text,
+    references and #if conditions compiled into a block are counted as part
+    of the block; turn codegen off for a finer breakdown.
+    """
+    timer = staticmethod(getattr(time, 'perf_counter', time.time))
+
+    def __init__(self):
+        # (filename, line, text) -> [calls, self time, cumulative time,
+        #                            output, {caller key: [calls, self time,
+        #                                                  cumulative time]}]
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def evaluate(self, element, stream, namespace, loader):
+        if getattr(self.local, 'run', None) is not None or \
+                sys.getprofile() is not None:
+            # a sub-template, or someone else is profiling
+            element.evaluate(stream, namespace, loader)
+            return
+        run = self.local.run = _ProfiledRun(self.timer)
+        sys.setprofile(run.event)
+        try:
+            element.evaluate(_CountingOutput(stream, run), namespace, loader)
+        finally:
+            sys.setprofile(None)
+            self.local.run = None
+            self.add(run)
+
+    def add(self, run):
+        with self.lock:
+            for key, (calls, self_time, cumulative, output, callers) in \
+                    run.stats.items():
+                stats = self.stats.setdefault(key, [0, 0.0, 0.0, 0, {}])
+                stats[0] += calls
+                stats[1] += self_time
+                stats[2] += cumulative
+                stats[3] += output
+                for caller, caller_stats in callers.items():
+                    totals = stats[4].setdefault(caller, [0, 0.0, 0.0])
+                    for i, value in enumerate(caller_stats):
+                        totals[i] += value
+
+    def clear(self):
+        with self.lock:
+            self.stats = {}
+
+    def entries(self, sort='cumulative'):
+        """Returns the figures for each element as dicts, largest first.
+
+        sort is the figure to order them by: 'calls', 'self', 'cumulative'
+        or 'output'.
+        """
+        with self.lock:
+            entries = [{'filename': filename, 'line': line, 'text': text,
+                        'calls': stats[0], 'self': stats[1],
+                        'cumulative': stats[2], 'output': stats[3]}
+                       for (filename, line, text), stats
+                       in self.stats.items()]
+        entries.sort(key=lambda entry: entry[sort], reverse=True)
+        return entries
+
+    def report(self, sort='cumulative', limit=None):
+        """Returns a table of the figures for each element, as text."""
+        lines = ['%8s %10s %10s %10s  %s' % ('calls', 'self ms', 'cumul ms',
+                                             'output', 'element')]
+        for entry in self.entries(sort)[:limit]:
+            lines.append('%8d %10.3f %10.3f %10d  %s:%d %s' % (
+                entry['calls'], entry['self'] * 1000,
+                entry['cumulative'] * 1000, entry['output'],
+                entry['filename'], entry['line'], entry['text']))
+        return '\n'.join(lines) + '\n'
+
+    def json_report(self, sort='cumulative', limit=None):
+        """Returns the figures for each element as a JSON list."""
+        return json.dumps(self.entries(sort)[:limit], indent=1)
+
+    def dump_stats(self, filename):
+        """Saves the figures in the format of the profile module.
+
+        The file can be loaded with pstats.Stats, with each element taking
+        the place of a function.
+        """
+        with self.lock:
+            stats = dict((key, (calls, calls, self_time, cumulative,
+                                dict((caller, (counts[0], counts[0],
+                                               counts[1], counts[2]))
+                                     for caller, counts in callers.items())))
+                         for key, (calls, self_time, cumulative, output,
+                                   callers) in self.stats.items())
+        f = open(filename, 'wb')
+        try:
+            marshal.dump(stats, f)
+        finally:
+            f.close()
+
+
+class _ProfiledRun:
+    """The figures recorded during one merge, in the thread doing it."""
+
+    def __init__(self, timer):
+        self.timer = timer
+        self.stats = {}
+        # [frame, key, start time, time in elements inside, output] for
+        # each element being evaluated, innermost last
+        self.stack = []
+        # key -> how many times the element is being evaluated, to count
+        # the time in recursive macros only once
+        self.active = {}
+        self.keys = {}
+        self.line_starts = {}
+
+    def event(self, frame, event, arg):
+        if event == 'call':
+            if frame.f_code.co_name == 'evaluate':
+                element = frame.f_locals.get('self')
+                if isinstance(element, _Element):
+                    key = self.key(element)
+                    self.active[key] = self.active.get(key, 0) + 1
+                    self.stack.append([frame, key, self.timer(), 0.0, 0])
+        elif event == 'return':
+            if self.stack and self.stack[-1][0] is frame:
+                self.leave()
+
+    def leave(self):
+        frame, key, start, inside, output = self.stack.pop()
+        elapsed = self.timer() - start
+        self.active[key] -= 1
+        stats = self.stats.setdefault(key, [0, 0.0, 0.0, 0, {}])
+        stats[0] += 1
+        stats[1] += elapsed - inside
+        cumulative = 0.0
+        if not self.active[key]:
+            cumulative = elapsed
+            stats[2] += elapsed
+            stats[3] += output
+        if self.stack:
+            caller = self.stack[-1]
+            caller[3] += elapsed
+            caller[4] += output
+            counts = stats[4].setdefault(caller[1], [0, 0.0, 0.0])
+            counts[0] += 1
+            counts[1] += elapsed - inside
+            counts[2] += cumulative
+
+    def output(self, length):
+        if self.stack:
+            self.stack[-1][4] += length
+
+    def key(self, element):
+        try:
+            return self.keys[element]
+        except KeyError:
+            pass
+        source = element.source
+        try:
+            line_starts = self.line_starts[source]
+        except KeyError:
+            line_starts = [0] + [m.end() for m in
+                                 re.finditer('\n', source.text)]
+            self.line_starts[source] = line_starts
+        line = bisect.bisect_right(line_starts, element.start)
+        text = ''
+        if not isinstance(element, (TemplateBody, Block)):
+            text = element.my_text().split('\n', 1)[0].strip()
+            if len(text) > 40:
+                text = text[:36] + ' ...'
+        if not text:
+            text = '(%s)' % element.__class__.__name__
+        key = self.keys[element] = (element.filename, line, text)
+        return key
+
+
+class _CountingOutput(OutputBuffer):
+    """Passes output straight on, counting it for the profiler."""
+
+    def __init__(self, stream, run):
+        OutputBuffer.__init__(self, stream)
+        self.run = run
+
+    def write(self, text):
+        self.run.output(len(text))
+        self.target(text)
+
+    def flush(self):
+        pass
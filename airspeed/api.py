@@ -24,14 +24,21 @@ class Airspeed(object):
 
     """
 
-    def __init__(self, cache=10, **kw):
+    def __init__(self, cache=10, macro_libraries=(), macro_basepath='', **kw):
         self.loaders = LRUCache(maxsize=cache)
+        # Macros every template can call, from the template files named in
+        # macro_libraries relative to macro_basepath (by default the current
+        # directory); parsed once, here, and shared by all the loaders
+        self.macro_basepath = os.path.abspath(macro_basepath)
+        self.macros = CachingFileLoader(
+            self.macro_basepath, macro_libraries=macro_libraries).macros
 
     def __call__(self, data, template, mime_type="text/plain", **options):
         basepath = os.path.dirname(template)
 
         if basepath not in self.loaders:
             loader = CachingFileLoader(basepath)
+            loader.macros = self.macros
             self.loaders[basepath] = loader
 
         else:
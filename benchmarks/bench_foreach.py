@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Measures what each pass through a #foreach loop costs.
+
+The loop body hands its $foreach to a Python list, so every object that the
+loop makes for an iteration is kept alive until the render has finished.
+tracemalloc then shows the memory those objects take, and the number of
+distinct $foreach objects shows whether anything was made per iteration.
+A second, plain render of the same loop is timed.
+
+    python benchmarks/bench_foreach.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import airspeed  # noqa: E402
+
+ROWS = 100000
+
+
+def main():
+    rows = list(range(ROWS))
+    keeping = airspeed.Template(
+        '#foreach($row in $rows)#if($seen.append($foreach))#end#end')
+    seen = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    keeping.merge({'rows': rows, 'seen': seen})
+    kept = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    distinct = len(set(id(frame) for frame in seen))
+    print('%d iterations' % ROWS)
+    print('distinct $foreach objects: %d' % distinct)
+    print('memory kept per iteration: %.1f bytes' % (float(kept) / ROWS))
+    del seen[:]
+
+    plain = airspeed.Template('#foreach($row in $rows)$row #end')
+    start = time.time()
+    plain.merge({'rows': rows})
+    elapsed = time.time() - start
+    print('render time per iteration: %.2f us' % (elapsed * 1e6 / ROWS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Compares worker start-up with and without CachingFileLoader's disk cache.
+
+A directory of templates is loaded by a fresh loader three times: without a
+cache directory, with an empty one (which also fills it) and with the
+filled one, the last being what a newly started worker process sees.  This
+is done with and without code generation, whose generated code is cached
+too.
+
+    python benchmarks/bench_loader_cache.py
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import airspeed  # noqa: E402
+
+TEMPLATE_COUNT = 200
+TEMPLATE = '''#macro(field $name $value)<input name="$name" value="$!value">#end
+<html><body>
+#foreach($row in $rows)
+  <tr class="#if($foreach.index % 2 == 0)even#else odd#end">
+    <td>$row.name</td><td>${row.price|'-'}</td><td>#field("qty" $row.qty)</td>
+  </tr>
+#end
+#set($total = 0)#foreach($row in $rows)#set($total = $total + $row.price)#end
+Total: $total
+</body></html>
+''' * 10
+
+
+def load_all(basedir, **options):
+    loader = airspeed.CachingFileLoader(basedir, **options)
+    start = time.time()
+    for i in range(TEMPLATE_COUNT):
+        loader.load_template('t%d.vm' % i)
+    return time.time() - start
+
+
+def main():
+    basedir = tempfile.mkdtemp()
+    try:
+        for i in range(TEMPLATE_COUNT):
+            f = open(os.path.join(basedir, 't%d.vm' % i), 'w')
+            f.write(TEMPLATE)
+            f.close()
+        print('%d templates of %d bytes' % (TEMPLATE_COUNT, len(TEMPLATE)))
+        for codegen in (False, True):
+            cache_dir = os.path.join(basedir, 'cache-%s' % codegen)
+            print('codegen %s' % ('on' if codegen else 'off'))
+            print('  no cache:        %.3fs' % load_all(
+                basedir, codegen=codegen))
+            print('  cold disk cache: %.3fs' % load_all(
+                basedir, codegen=codegen, cache_dir=cache_dir))
+            print('  warm disk cache: %.3fs' % load_all(
+                basedir, codegen=codegen, cache_dir=cache_dir))
+    finally:
+        shutil.rmtree(basedir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Measures the memory a parsed template keeps.
+
+Several copies of the same template are parsed and kept, as a template cache
+would, and tracemalloc shows how much memory each of them holds on to.  The
+number of elements in a template is printed alongside, to give the cost per
+element, together with Template.approximate_size() for comparison.
+
+    python benchmarks/bench_memory.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import airspeed  # noqa: E402
+
+TEMPLATES = 20
+SECTION = '''<div class="$row.kind">
+  #if($row.visible && $row.count > 1)
+    <a href="$base/items/${row.id}?page=$page">$row.title</a>
+  #elseif($row.hidden)
+    #set($hidden = $hidden + 1)
+  #else
+    <span>#foreach($tag in $row.tags)$tag#if($foreach.hasNext), #end#end</span>
+  #end
+  ## a comment
+  <p>${row.description|"none"} #macro_name($row "text" [1, 2, 3])</p>
+</div>
+'''
+CONTENT = SECTION * 200
+
+
+def count_elements(template):
+    count = 0
+    pending = [template.root_element]
+    while pending:
+        element = pending.pop()
+        count += 1
+        pending.extend(element.child_elements())
+    return count
+
+
+def measure(codegen):
+    kept = []
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.time()
+    for i in range(TEMPLATES):
+        template = airspeed.Template(CONTENT, 'page%d.vm' % i, codegen)
+        template.ensure_compiled()
+        kept.append(template)
+    elapsed = time.time() - start
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    template = kept[0]
+    per_template = float(used) / TEMPLATES
+    elements = count_elements(template)
+    print('codegen=%s' % codegen)
+    print('  elements per template: %d' % elements)
+    print('  memory per template: %.0f KiB (%.0f bytes per element)' %
+          (per_template / 1024, per_template / elements))
+    print('  approximate_size(): %.0f KiB' %
+          (template.approximate_size() / 1024.0))
+    print('  parse time per template: %.1f ms' % (elapsed * 1000 / TEMPLATES))
+
+
+def main():
+    print('%d templates of %d characters' % (TEMPLATES, len(CONTENT)))
+    for codegen in (False, True):
+        measure(codegen)
+
+
+if __name__ == '__main__':
+    main()
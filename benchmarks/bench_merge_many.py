@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Compares merging a template with many namespaces one by one and in bulk.
+
+The template is merged with each namespace in turn with Template.merge, and
+then with Template.merge_many for a range of worker counts, as a nightly
+mail-merge job would.  The namespaces are made by a generator, so the peak
+memory of the process also shows that they are not all read at once.
+
+    python benchmarks/bench_merge_many.py
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import airspeed  # noqa: E402
+
+NAMESPACES = 20000
+TEMPLATE = '''Dear $customer.name,
+
+Your statement for $month:
+#foreach($line in $customer.lines)
+  $line.date  ${line.description|"-"}  #if($line.amount < 0)
+($line.amount)#else$line.amount#end
+
+#end
+#set($total = 0)
+#foreach($line in $customer.lines)#set($total = $total + $line.amount)#end
+Balance: $total
+'''
+
+
+def namespaces():
+    for i in range(NAMESPACES):
+        lines = [{'date': '2024-01-%02d' % (j + 1),
+                  'description': 'item %d' % j,
+                  'amount': (i * j) % 200 - 50} for j in range(20)]
+        yield {'customer': {'name': 'Customer %d' % i, 'lines': lines},
+               'month': 'January'}
+
+
+def main():
+    template = airspeed.Template(TEMPLATE)
+    print('%d namespaces, %d CPUs' % (NAMESPACES,
+                                      multiprocessing.cpu_count()))
+    start = time.time()
+    size = sum(len(template.merge(namespace)) for namespace in namespaces())
+    print('merge:                 %6.2fs' % (time.time() - start))
+    workers = 1
+    while workers <= multiprocessing.cpu_count():
+        start = time.time()
+        merged = sum(len(output) for output in
+                     template.merge_many(namespaces(), workers=workers))
+        assert merged == size
+        print('merge_many, %2d workers: %6.2fs' % (workers,
+                                                   time.time() - start))
+        workers *= 2
+    print('peak memory: %.1f MB' % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
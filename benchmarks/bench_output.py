@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Measures rendering straight into a file with Template.merge_to.
+
+The output goes to an unbuffered binary file, so every chunk passed on costs
+a system call, as it would for a socket.  A flush_size of 1 passes on each
+piece of text as it is written, which is what merge_to used to do.
+
+    python benchmarks/bench_output.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import airspeed  # noqa: E402
+
+ROWS = 50000
+TEMPLATE = '#foreach($row in $rows)<tr><td>$row.id</td><td>$row.name</td>' \
+           '</tr>\n#end'
+
+
+class CountingFile(object):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.fileobj.write(data)
+
+
+def main():
+    template = airspeed.Template(TEMPLATE)
+    rows = [{'id': i, 'name': u'row \u2116%d' % i} for i in range(ROWS)]
+    print('%d rows' % ROWS)
+    for flush_size in (1, 4096, airspeed.OutputBuffer.FLUSH_SIZE):
+        with open(os.devnull, 'wb', 0) as devnull:
+            output = CountingFile(devnull)
+            start = time.time()
+            template.merge_to({'rows': rows}, output, flush_size=flush_size,
+                              encoding='utf-8')
+            elapsed = time.time() - start
+        print('flush_size=%-6d %8d writes %8.1f ms' %
+              (flush_size, output.writes, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
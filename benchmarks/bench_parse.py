@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""Measures how parse time grows with the size of a template.
+
+Each run parses a template made of the same chunk of markup repeated, from
+a few hundred kilobytes up to several megabytes.  Parsing is linear when the
+time per megabyte stays roughly constant as the template grows.
+
+    python benchmarks/bench_parse.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import airspeed  # noqa: E402
+
+CHUNK = ('<tr><td>$row.name</td><td>$!row.price</td>'
+         '#if($row.price > 10)<b>dear</b>#else cheap#end</tr>\n'
+         '#foreach($i in [1..3])$i#end ## comment\n'
+         '#set($total = $total + $row.price) \\$escaped #ffffff\n')
+
+
+def parse_time(content):
+    start = time.time()
+    airspeed.Template(content).ensure_compiled()
+    return time.time() - start
+
+
+def main():
+    print('%10s %10s %10s' % ('bytes', 'seconds', 's/MB'))
+    repeats = 2000
+    while repeats <= 32000:
+        content = CHUNK * repeats
+        elapsed = parse_time(content)
+        print('%10d %10.3f %10.3f' % (
+            len(content), elapsed, elapsed * 1000000 / len(content)))
+        repeats *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""Times parsing, compiling and rendering on a set of representative templates.
+
+Each benchmark is run once to warm up and then timed several times, and the
+mean and standard deviation of those samples are printed.  The results can be
+saved as JSON and compared with those of an earlier run, to see whether a
+change made anything faster or slower:
+
+    python benchmarks/suite.py -o before.json
+    ... change something ...
+    python benchmarks/suite.py -o after.json --compare before.json
+    python benchmarks/suite.py --compare before.json after.json
+
+A difference is only reported as faster or slower when it is large compared
+with the spread of the samples.  Benchmarks can be picked by name with -k,
+and --codegen renders with Template.codegen turned on.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import airspeed  # noqa: E402
+
+timer = getattr(time, 'perf_counter', time.time)
+
+BENCHMARKS = []
+
+
+def benchmark(loops=1):
+    """Registers a function which sets up a benchmark.
+
+    The function is called once and returns the function to time, which is
+    called loops times per sample.
+    """
+    def register(setup):
+        BENCHMARKS.append((setup.__name__, loops, setup))
+        return setup
+    return register
+
+
+class Row(object):
+    def __init__(self, i):
+        self.id = i
+        self.name = 'row %d' % i
+        self.owner = {'address': {'city': 'City %d' % (i % 10)}}
+
+    def getTitle(self):
+        return self.name.title()
+
+
+MIXED = '''<div class="$row.kind">
+  #if($row.visible && $row.count > 1)
+    <a href="$base/items/${row.id}?page=$page">$row.title</a>
+  #elseif($row.hidden)
+    #set($hidden = $hidden + 1)
+  #else
+    <span>#foreach($tag in $row.tags)$tag#if($foreach.hasNext), #end#end</span>
+  #end
+  ## a comment
+  #macro(cell $value)<td>$!value</td>#end
+  #cell($row.price)
+</div>
+'''
+
+
+def rendering(content, namespace, loader=None):
+    template = airspeed.Template(content)
+    template.ensure_compiled()
+    # #macro and #set change the namespace, so each merge gets a copy
+    return lambda: template.merge(dict(namespace), loader=loader)
+
+
+@benchmark(loops=100)
+def static_text():
+    text = ('<p>Nothing but plain text, with no references or directives '
+            'in it at all.</p>\n') * 14000
+    return rendering(text, {})
+
+
+@benchmark()
+def foreach_100k_rows():
+    rows = [{'id': i, 'name': 'row %d' % i} for i in range(100000)]
+    return rendering('#foreach($row in $rows)<tr><td>$row.id</td>'
+                     '<td>$row.name</td></tr>\n#end', {'rows': rows})
+
+
+@benchmark()
+def property_chains():
+    rows = [Row(i) for i in range(10000)]
+    return rendering('#foreach($row in $rows)$row.owner.address.city '
+                     '$row.title $row.name.upper() ${row.owner.missing.x|"-"}'
+                     '\n#end', {'rows': rows})
+
+
+@benchmark()
+def macro_heavy_page():
+    content = '''#macro(cell $value)<td>$!value</td>#end
+#macro(row $item)<tr>#cell($item.id)#cell($item.name)#cell($item.price)</tr>
+#end
+#macro(table $items)<table>#foreach($item in $items)#row($item)#end</table>
+#end
+#foreach($i in [1..20])#table($items)#end
+'''
+    items = [{'id': i, 'name': 'item %d' % i, 'price': i * 3}
+             for i in range(100)]
+    return rendering(content, {'items': items})
+
+
+@benchmark()
+def parse_fan_out():
+    basedir = tempfile.mkdtemp()
+    CLEANUP.append(lambda: shutil.rmtree(basedir))
+    for i in range(50):
+        f = open(os.path.join(basedir, 'part%d.vm' % i), 'w')
+        f.write('<section id="$name-%d">#foreach($x in $items)$x #end'
+                '</section>\n' % i)
+        f.close()
+    f = open(os.path.join(basedir, 'page.vm'), 'w')
+    f.write('#foreach($i in [1..20])#foreach($j in [0..49])'
+            '#parse("part${j}.vm")#end#end')
+    f.close()
+    loader = airspeed.CachingFileLoader(basedir)
+    template = loader.load_template('page.vm')
+    namespace = {'name': 'n', 'items': list(range(10))}
+    return lambda: template.merge(dict(namespace), loader=loader)
+
+
+@benchmark()
+def expression_chains():
+    content = '''#foreach($i in [1..20000])
+#set($x = $a + $b * 2 - $c / 3 + $i % 7 - ($a - $b) * ($c + $i))
+#if($x > 10 && $x < 1000000 || $i == 3 && !$flag || $x >= $b)$x#end
+#end'''
+    return rendering(content, {'a': 5, 'b': 7, 'c': 11, 'flag': False})
+
+
+def one_megabyte_template():
+    return MIXED * (1024 * 1024 // len(MIXED) + 1)
+
+
+@benchmark()
+def parse_1mb():
+    content = one_megabyte_template()
+
+    def parse():
+        airspeed.Template(content, codegen=False).ensure_compiled()
+    return parse
+
+
+@benchmark()
+def parse_and_compile_1mb():
+    content = one_megabyte_template()
+
+    def compile():
+        airspeed.Template(content, codegen=True).ensure_compiled()
+    return compile
+
+
+CLEANUP = []
+
+
+def run_benchmark(setup, loops, samples):
+    function = setup()
+    function()
+    times = []
+    for _ in range(samples):
+        start = timer()
+        for _ in range(loops):
+            function()
+        times.append((timer() - start) / loops)
+    return times
+
+
+def format_time(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e3), ('us', 1e6)):
+        if seconds * scale >= 1:
+            break
+    return '%.2f %s' % (seconds * scale, unit)
+
+
+def summarize(times):
+    mean = sum(times) / len(times)
+    variance = sum((t - mean) ** 2 for t in times) / max(len(times) - 1, 1)
+    return mean, math.sqrt(variance)
+
+
+def run(names, samples, codegen):
+    airspeed.Template.codegen = codegen
+    results = {}
+    try:
+        for name, loops, setup in BENCHMARKS:
+            if names and not any(n in name for n in names):
+                continue
+            times = run_benchmark(setup, loops, samples)
+            results[name] = times
+            mean, stdev = summarize(times)
+            print('%-24s %12s +- %s' % (name, format_time(mean),
+                                         format_time(stdev)))
+            sys.stdout.flush()
+    finally:
+        airspeed.Template.codegen = False
+        while CLEANUP:
+            CLEANUP.pop()()
+    return {
+        'metadata': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'codegen': codegen,
+            'samples': samples,
+        },
+        'benchmarks': results,
+    }
+
+
+def significant(before, after):
+    """True if the means of two lists of samples differ by more than chance.
+
+    Uses Welch's t-test, with the same rough threshold as pyperf.
+    """
+    mean_before, stdev_before = summarize(before)
+    mean_after, stdev_after = summarize(after)
+    error = math.sqrt(stdev_before ** 2 / len(before) +
+                      stdev_after ** 2 / len(after))
+    if not error:
+        return mean_before != mean_after
+    return abs(mean_before - mean_after) / error > 2.0
+
+
+def compare(before, after):
+    print('%-24s %12s %12s  %s' % ('benchmark', 'before', 'after', 'change'))
+    for name in sorted(set(before['benchmarks']) & set(after['benchmarks'])):
+        old, new = before['benchmarks'][name], after['benchmarks'][name]
+        mean_before, mean_after = summarize(old)[0], summarize(new)[0]
+        if not significant(old, new):
+            change = 'not significant'
+        elif mean_after < mean_before:
+            change = '%.2fx faster' % (mean_before / mean_after)
+        else:
+            change = '%.2fx slower' % (mean_after / mean_before)
+        print('%-24s %12s %12s  %s' % (name, format_time(mean_before),
+                                       format_time(mean_after), change))
+    for key in ('codegen', 'python'):
+        if before['metadata'].get(key) != after['metadata'].get(key):
+            print('note: %s differs: %r before, %r after' % (
+                key, before['metadata'].get(key), after['metadata'].get(key)))
+
+
+def load(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0])
+    parser.add_argument('-k', dest='names', action='append', default=[],
+                        help='only run benchmarks whose name contains NAMES')
+    parser.add_argument('-n', '--samples', type=int, default=5,
+                        help='timed runs of each benchmark (default 5)')
+    parser.add_argument('--codegen', action='store_true',
+                        help='render with Template.codegen turned on')
+    parser.add_argument('-o', '--output',
+                        help='save the results to this JSON file')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help='compare with saved results; given two files, '
+                             'compare those without running anything')
+    parser.add_argument('--list', action='store_true',
+                        help='list the benchmarks and exit')
+    args = parser.parse_args()
+    if args.list:
+        for name, _, _ in BENCHMARKS:
+            print(name)
+        return
+    if args.compare and len(args.compare) > 2:
+        parser.error('--compare takes one or two files')
+    if args.compare and len(args.compare) == 2:
+        compare(load(args.compare[0]), load(args.compare[1]))
+        return
+    results = run(args.names, args.samples, args.codegen)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        print()
+        compare(load(args.compare[0]), results)
+
+
+if __name__ == '__main__':
+    main()
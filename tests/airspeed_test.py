@@ -1,7 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import io
+import json
+import multiprocessing.pool
+import os
+import pickle
+import pstats
 import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
+import warnings
 if sys.version_info >= (3, 0) and sys.version_info <= (3, 3):
     import imp
 elif sys.version_info >= (3, 4):
@@ -16,10 +27,37 @@ except ImportError:
     import os
     sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
     import airspeed
+from airspeed.api import Airspeed
 
 import six
 
 
+class LoopOnceDirective(airspeed._Element):
+    """A user-defined directive, which must be picklable along with the
+    templates using it."""
+    START = re.compile(r'#once\b', re.S)
+
+    def parse(self):
+        self.identity_match(self.START)
+        self.block = self.next_element(airspeed.Block)
+        self.next_element(airspeed.End)
+
+    def evaluate(self, stream, namespace, loader):
+        self.block.evaluate(stream, namespace, loader)
+
+
+class UnpicklableError(Exception):
+    """Raised in merge_many workers, which cannot send it back."""
+    def __init__(self):
+        Exception.__init__(self)
+        self.callback = lambda: None
+
+
+class FailsUnpicklably(object):
+    def fail(self):
+        raise UnpicklableError()
+
+
 class TemplateTestCase(TestCase):
     def assertRaisesExecutionError(self, exctype, func, *args, **kwargs):
         try:
@@ -113,6 +151,12 @@ class TemplateTestCase(TestCase):
         template = airspeed.Template("${a|$b}")
         self.assertEqual("hello", template.merge({'b': "hello"}))
 
+    def test_formal_reference_with_only_an_alternate_value(self):
+        self.assertEqual("x", airspeed.Template("${|'x'}").merge({}))
+        self.assertEqual("x", airspeed.Template("$!{|'x'}").merge({}))
+        self.assertEqual("y", airspeed.Template("${|$b}").merge({'b': 'y'}))
+        self.assertEqual("$!{}", airspeed.Template("$!{}").merge({}))
+
     def test_can_return_value_from_an_attribute_of_a_context_object(self):
         template = airspeed.Template("Hello $name.first_name")
 
@@ -342,6 +386,45 @@ class TemplateTestCase(TestCase):
         template.merge_to({"name": "Chris"}, output)
         self.assertEqual('Hello Chris!', output.getvalue())
 
+    def test_merge_to_writes_output_in_chunks(self):
+        class RecordingFile:
+            def __init__(self):
+                self.writes = []
+
+            def write(self, text):
+                self.writes.append(text)
+
+        template = airspeed.Template('#foreach($i in [1..10])$i,#end')
+        output = RecordingFile()
+        template.merge_to({}, output, flush_size=6)
+        self.assertEqual(['1,2,3,', '4,5,6,', '7,8,9,', '10,'], output.writes)
+
+    def test_merge_to_encodes_output_for_binary_files(self):
+        template = airspeed.Template(u'caf\xe9 $name')
+        output = io.BytesIO()
+        template.merge_to({'name': u'\u263a'}, output, encoding='utf-8')
+        self.assertEqual(u'caf\xe9 \u263a'.encode('utf-8'), output.getvalue())
+
+    def test_merge_to_sends_output_to_sockets(self):
+        class Socket(object):
+            def __init__(self):
+                self.sent = []
+
+            def sendall(self, data):
+                self.sent.append(data)
+
+        template = airspeed.Template('$a $b')
+        output = Socket()
+        template.merge_to({'a': 1, 'b': 2}, output, encoding='ascii')
+        self.assertEqual([b'1 2'], output.sent)
+
+    def test_merge_to_passes_on_output_written_before_an_error(self):
+        template = airspeed.Template('before #set($x = 1 / 0)')
+        output = six.StringIO()
+        self.assertRaises(airspeed.TemplateExecutionError,
+                          template.merge_to, {}, output)
+        self.assertEqual('before ', output.getvalue())
+
     def test_string_literal_can_contain_embedded_escaped_quotes(self):
         template = airspeed.Template('#set ($name = "\\"batman\\"")$name')
         self.assertEqual('"batman"', template.merge({}))
@@ -458,6 +541,9 @@ $email
             airspeed.Template('#if ( $hello )\n\n#elseif blah').merge({})
         except airspeed.TemplateSyntaxError as e:
             self.assertEqual((3, 9), (e.line, e.column))
+            self.assertTrue(e.args[0].startswith('line 3, column 9: '),
+                            e.args)
+            self.assertEqual(e.args[0], str(e))
         else:
             self.fail('expected error')
         try:
@@ -667,6 +753,7 @@ $email
                 'parse',
                 'include',
                 'stop',
+                'break',
                 'end'):
             template = airspeed.Template(
                 '#macro ( %s $value) $value #end' %
@@ -728,6 +815,32 @@ $email
             template.merge,
             {})  # Should this be TemplateSyntaxError?
 
+    def test_macro_calls_are_bound_when_parsed(self):
+        template = airspeed.Template(
+            '#macro(a $x)[$x]#end#foreach($i in [1, 2])#a($i)#end'
+            '#set($s = "#a(3)")$s')
+        template.ensure_compiled()
+        definition = template.root_element.macros['#a']
+        calls = []
+        elements = [template.root_element]
+        while elements:
+            element = elements.pop()
+            if isinstance(element, airspeed.MacroCall):
+                calls.append(element)
+            elements.extend(element.child_elements())
+        self.assertEqual([definition] * 2, [call.macro for call in calls])
+        self.assertEqual('[1][2][3]', template.merge({}))
+        template = pickle.loads(pickle.dumps(template))
+        self.assertEqual('[1][2][3]', template.merge({}))
+
+    def test_macro_can_be_called_before_its_definition(self):
+        template = airspeed.Template('#later(1)#macro(later $x)<$x>#end')
+        self.assertEqual('<1>', template.merge({}))
+
+    def test_macro_call_with_wrong_number_of_arguments_fails(self):
+        template = airspeed.Template('#macro(m $x)$x#end#m(1 2)')
+        self.assertRaises(airspeed.TemplateExecutionError, template.merge, {})
+
     def test_can_call_macro_with_newline_between_args(self):
         template = airspeed.Template(
             '#macro (hello $value1 $value2 )hello $value1 and $value2#end\n#hello (1,\n 2)')
@@ -973,10 +1086,206 @@ $email
         self.assertEqual('hello monkey', template.merge({}))
         airspeed.UserDefinedDirective.DIRECTIVES.remove(DummyDirective)
 
+    def test_user_defined_directive_matching_only_its_own_text(self):
+        class DummyDirective(airspeed._Element):
+            PLAIN = re.compile(r'#(monkey)man', re.I)
+
+            def parse(self):
+                self.text, = self.identity_match(self.PLAIN)
+
+            def evaluate(self, stream, namespace, loader):
+                stream.write(self.text)
+
+        airspeed.UserDefinedDirective.DIRECTIVES.append(DummyDirective)
+        try:
+            template = airspeed.Template("hello #monkeyman $name")
+            self.assertEqual('hello monkey bob', template.merge({'name': 'bob'}))
+        finally:
+            airspeed.UserDefinedDirective.DIRECTIVES.remove(DummyDirective)
+
+    def test_user_defined_directive_implementing_evaluate_raw(self):
+        class DummyDirective(airspeed._Element):
+            PLAIN = re.compile(r'#(monkey|ape)man', re.I)
+
+            def parse(self):
+                self.text, = self.identity_match(self.PLAIN)
+
+            def evaluate_raw(self, stream, namespace, loader):
+                if self.text == 'ape':
+                    raise ValueError('no apes')
+                stream.write(self.text)
+
+        airspeed.UserDefinedDirective.DIRECTIVES.append(DummyDirective)
+        try:
+            template = airspeed.Template("hello #monkeyman $name")
+            self.assertEqual('hello monkey bob',
+                             template.merge({'name': 'bob'}))
+            template = airspeed.Template("hello #apeman")
+            try:
+                template.merge({})
+                self.fail('expected exception')
+            except airspeed.TemplateExecutionError as e:
+                self.assertEqual((6, 13), (e.start, e.end))
+        finally:
+            airspeed.UserDefinedDirective.DIRECTIVES.remove(DummyDirective)
+
+    def test_user_defined_directive_calling_evaluate_raw_on_its_block(self):
+        class TwiceDirective(airspeed._Element):
+            START = re.compile(r'#twice\b', re.S)
+
+            def parse(self):
+                self.identity_match(self.START)
+                self.block = self.next_element(airspeed.Block)
+                self.next_element(airspeed.End)
+
+            def evaluate_raw(self, stream, namespace, loader):
+                for i in range(2):
+                    self.block.evaluate_raw(stream, namespace, loader)
+
+        airspeed.UserDefinedDirective.DIRECTIVES.append(TwiceDirective)
+        try:
+            template = airspeed.Template('#twice[$a#if($a)!#end]#end')
+            self.assertEqual('[1!][1!]', template.merge({'a': 1}))
+        finally:
+            airspeed.UserDefinedDirective.DIRECTIVES.remove(TwiceDirective)
+
+    def test_large_template_parses(self):
+        template = airspeed.Template('$a #if($a)x#end\n' * 5000)
+        self.assertEqual('1 x' * 5000, template.merge({'a': 1}))
+
+    def test_hashes_and_dollars_not_starting_anything_are_text(self):
+        template = airspeed.Template('#ffffff #abc #{ #} #1 #END # $ $1x')
+        self.assertEqual('#ffffff #abc #{ #} #1 #END # $ $1x', template.merge({}))
+
+    def test_directive_names_are_case_insensitive(self):
+        template = airspeed.Template('#SET($a = 1)#IF($a == 1)yes#else no#end')
+        self.assertEqual('yes', template.merge({}))
+
     def test_stop_directive(self):
         template = airspeed.Template("hello #stop world")
         self.assertEqual('hello ', template.merge({}))
 
+    def test_merge_iter_yields_same_output_as_merge(self):
+        class WorkingLoader:
+            def load_template(self, name):
+                return airspeed.Template('[#foreach($j in [1..2])$j#end]')
+
+        template = airspeed.Template(
+            '#macro(m $x)<$x>#end'
+            '#foreach($i in $items)#if($i > 1)#m($i)#else $i#end#end'
+            '#parse("sub") $!missing done')
+        namespace = {'items': [1, 2, 3]}
+        expected = template.merge(namespace, loader=WorkingLoader())
+        self.assertEqual(' 1<2><3>[12]  done', expected)
+        self.assertEqual(expected, ''.join(template.merge_iter(
+            {'items': [1, 2, 3]}, loader=WorkingLoader(), chunk_size=1)))
+
+    def test_merge_iter_yields_chunks_of_at_least_chunk_size(self):
+        template = airspeed.Template('#foreach($i in [1..100])$i,#end')
+        chunks = list(template.merge_iter({}, chunk_size=10))
+        self.assertEqual(template.merge({}), ''.join(chunks))
+        self.assertTrue(len(chunks) > 10)
+        for chunk in chunks[:-1]:
+            self.assertTrue(len(chunk) >= 10)
+
+    def test_merge_iter_yields_output_before_evaluation_finishes(self):
+        class Recorder:
+            calls = 0
+
+            def see(self, value):
+                self.calls += 1
+                return value
+
+        recorder = Recorder()
+        template = airspeed.Template('#foreach($i in [1..1000])$r.see($i)#end')
+        chunks = template.merge_iter({'r': recorder}, chunk_size=5)
+        self.assertEqual('12345', next(chunks))
+        self.assertEqual(5, recorder.calls)
+        chunks.close()
+
+    def test_merge_iter_ends_at_stop_directive(self):
+        template = airspeed.Template(
+            '#foreach($i in [1..10])$i#if($i == 3)#stop#end#end')
+        self.assertEqual(['123'], list(template.merge_iter({})))
+
+    def test_merge_iter_reports_failing_element(self):
+        template = airspeed.Template('ab\n#foreach($i in $l)$i.f()#end', 't')
+        try:
+            list(template.merge_iter({'l': [{'f': 1}]}, chunk_size=1))
+            self.fail('expected exception')
+        except airspeed.TemplateExecutionError as e:
+            self.assertEqual((21, 27), (e.start, e.end))
+            self.assertTrue(isinstance(e.__cause__, TypeError))
+
+    def test_stop_directive_halts_evaluation(self):
+        class RecordingNamespace(dict):
+            def __init__(self, *args):
+                dict.__init__(self, *args)
+                self.looked_up = []
+
+            def __getitem__(self, key):
+                self.looked_up.append(key)
+                return dict.__getitem__(self, key)
+
+        namespace = RecordingNamespace({'a': 1, 'b': 2, 'items': [1, 2]})
+        template = airspeed.Template(
+            '$a#stop$b#foreach($i in $items)$i#end#set($c = $b)')
+        self.assertEqual('1', template.merge(namespace))
+        self.assertEqual(['a'], namespace.looked_up)
+
+    def test_stop_directive_inside_foreach_ends_loop_and_template(self):
+        class Recorder:
+            calls = 0
+
+            def see(self, value):
+                self.calls += 1
+                return value
+
+        recorder = Recorder()
+        template = airspeed.Template(
+            '#foreach($i in [1..10])$r.see($i)#if($i == 3)#stop#end#end'
+            '$r.see("after")')
+        self.assertEqual('123', template.merge({'r': recorder}))
+        self.assertEqual(3, recorder.calls)
+
+    def test_stop_directive_in_macro_and_parsed_template_ends_everything(self):
+        class WorkingLoader:
+            def load_template(self, name):
+                return airspeed.Template('in parsed #stop more')
+
+        template = airspeed.Template(
+            '#macro(halt)in macro #stop#end#halt() after')
+        self.assertEqual('in macro ', template.merge({}))
+        template = airspeed.Template('before #parse("x") after')
+        self.assertEqual('before in parsed ',
+                         template.merge({}, loader=WorkingLoader()))
+
+    def test_stop_directive_in_string_only_ends_the_string(self):
+        template = airspeed.Template('#set($s = "a#stop b")$s after')
+        self.assertEqual('a after', template.merge({}))
+
+    def test_break_directive_leaves_innermost_foreach(self):
+        template = airspeed.Template(
+            '#foreach($i in [1..3])#foreach($j in [1..3])'
+            '#if($j == 2)#break#end$i$j #end#end done')
+        self.assertEqual('11 21 31  done', template.merge({}))
+
+    def test_break_directive_leaves_macro_and_parsed_template(self):
+        class WorkingLoader:
+            def load_template(self, name):
+                return airspeed.Template('in parsed #break more')
+
+        template = airspeed.Template(
+            '#macro(leave)in macro #break more#end#leave() after')
+        self.assertEqual('in macro  after', template.merge({}))
+        template = airspeed.Template('before #parse("x") after')
+        self.assertEqual('before in parsed  after',
+                         template.merge({}, loader=WorkingLoader()))
+
+    def test_break_directive_outside_foreach_ends_template(self):
+        template = airspeed.Template('hello #break world')
+        self.assertEqual('hello ', template.merge({}))
+
     def test_assignment_of_parenthesized_math_expression(self):
         template = airspeed.Template('#set($a = (5 + 4))$a')
         self.assertEqual('9', template.merge({}))
@@ -1108,6 +1417,32 @@ line")''')
             self.assertEqual(142, e.end)
             self.assertTrue(isinstance(e.__cause__, TypeError))
 
+    def test_error_is_reported_against_innermost_statement(self):
+        template = airspeed.Template(
+            '#macro(m $v)\n#foreach($i in $v)\n#set($x = 1 / $i)#end#end'
+            '#m([0])', 't')
+        try:
+            template.merge({})
+            self.fail('expected exception')
+        except airspeed.TemplateExecutionError as e:
+            self.assertEqual('($x = 1 / $i)', e.element.my_text())
+            self.assertEqual(
+                "Error in template 't' at position 36-49 in expression: "
+                "($x = 1 / $i)\nZeroDivisionError: "
+                "integer division or modulo by zero", str(e))
+
+    def test_error_in_included_template_is_reported_against_its_element(self):
+        class InnerLoader:
+            def load_template(self, name):
+                return airspeed.Template('x\n$a.b()', name)
+
+        template = airspeed.Template('#parse("inner")', 'outer')
+        try:
+            template.merge({'a': {'b': 1}}, loader=InnerLoader())
+            self.fail('expected exception')
+        except airspeed.TemplateExecutionError as e:
+            self.assertEqual(('inner', 2, 8), (e.filename, e.start, e.end))
+
     def test_outer_variable_assignable_from_foreach_block(self):
         template = airspeed.Template(
             "#set($var = 1)#foreach ($i in $items)"
@@ -1129,6 +1464,250 @@ line")''')
             "$foreach.count|#end")
         self.assertEqual("1,2,1|1,2,2|", template.merge({}))
 
+    def test_foreach_block_variables_do_not_survive_to_next_iteration(self):
+        template = airspeed.Template(
+            "#foreach ($i in [1, 2, 3])[$!x]#set($x = $i)#end")
+        self.assertEqual("[][][]", template.merge({}))
+
+    def test_foreach_variable_can_be_used_as_a_dict(self):
+        template = airspeed.Template(
+            "#foreach ($i in [1, 2])$foreach.get('index')$foreach[\"last\"],"
+            "#end")
+        self.assertEqual("0False,1True,", template.merge({}))
+
+    def test_foreach_variable_has_the_methods_of_a_dict(self):
+        template = airspeed.Template(
+            "#foreach ($i in [1, 2])$sorted($foreach.keys()) "
+            "$len($foreach.items()) $foreach.get('x', '-')\n#end")
+        self.assertEqual(
+            "['count', 'first', 'hasNext', 'index', 'last'] 5 -\n" * 2,
+            template.merge({'sorted': sorted, 'len': len}))
+        frames = []
+        airspeed.Template(
+            "#foreach ($i in [1])#if($frames.append($foreach))#end#end"
+        ).merge({'frames': frames})
+        self.assertEqual({'count': 1, 'index': 0, 'hasNext': False,
+                          'first': True, 'last': True}, dict(frames[0]))
+
+    def test_foreach_over_generator(self):
+        template = airspeed.Template(
+            "#foreach ($i in $items)$i#if($foreach.hasNext),#end#end")
+        items = (i * i for i in range(1, 4))
+        self.assertEqual("1,4,9", template.merge({"items": items}))
+
+    def test_foreach_takes_items_one_at_a_time(self):
+        taken = []
+
+        def items():
+            for i in range(1, 100):
+                taken.append(i)
+                yield i
+        template = airspeed.Template(
+            "#foreach ($i in $items)$i$foreach.last#if($i == 2)#break#end#end")
+        self.assertEqual("1False2False", template.merge({"items": items()}))
+        self.assertEqual([1, 2, 3], taken)
+
+    def test_foreach_over_empty_iterator(self):
+        template = airspeed.Template("#foreach ($i in $items)$i#end.")
+        self.assertEqual(".", template.merge({"items": iter([])}))
+
+    def test_loop_variables_of_enclosing_loops_are_visible(self):
+        template = airspeed.Template(
+            "#foreach ($i in [1, 2])#foreach ($j in [3])"
+            "#if ($j)$i$j$foreach.count$velocityCount,#end#end#end")
+        self.assertEqual("1311,2311,", template.merge({}))
+
+    def test_macro_body_sees_the_namespace_it_is_called_from(self):
+        template = airspeed.Template(
+            "#foreach ($i in [1])#macro(m $a)$a$i#end#end"
+            "#set($i = 'x')#m('a')"
+            "#foreach ($i in [2])#foreach ($j in [3])#m($j)#end#end")
+        self.assertEqual("ax32", template.merge({}))
+
+    def test_loop_variables_are_bound_when_parsed(self):
+        template = airspeed.Template(
+            "#macro(m $a)$a.b#end#foreach ($i in [1])$i$x$foreach.count#end")
+        template.ensure_compiled()
+        depths = {}
+        elements = [template.root_element]
+        while elements:
+            element = elements.pop()
+            if isinstance(element, airspeed.NameOrCall):
+                depths[element.name] = element.scope_depth
+            elements.extend(element.child_elements())
+        self.assertEqual({'a': 0, 'b': None, 'i': 0, 'x': None,
+                          'foreach': 0, 'count': None}, depths)
+
+    def test_user_defined_directives_get_no_bound_references(self):
+        class LoopOnce(airspeed._Element):
+            START = re.compile(r'#once\b')
+
+            def parse(self):
+                self.identity_match(self.START)
+                self.block = self.next_element(airspeed.Block)
+                self.require_next_element(airspeed.End, '#end')
+
+            def evaluate(self, stream, namespace, loader):
+                localns = airspeed.LocalNamespace(namespace)
+                localns['i'] = 'inner'
+                self.block.evaluate(stream, localns, loader)
+
+        airspeed.UserDefinedDirective.DIRECTIVES.append(LoopOnce)
+        try:
+            template = airspeed.Template(
+                "#foreach ($i in [1])#once$i/$foreach.count#end#end")
+            self.assertEqual('inner/1', template.merge({}))
+            once = template.root_element.block.children[0].block.children[
+                0].directive
+            self.assertEqual([None, None], [
+                child.expression.part.scope_depth
+                for child in once.block.children if child.my_text() != '/'])
+        finally:
+            airspeed.UserDefinedDirective.DIRECTIVES.remove(LoopOnce)
+
+    def test_reference_sees_objects_of_different_types(self):
+        class WithAttribute(object):
+            a = 'attr'
+
+        class WithItems(object):
+            def __getitem__(self, key):
+                return key.upper()
+        template = airspeed.Template("#foreach ($x in $items)$x.a,#end")
+        items = [{'a': 'key'}, WithAttribute(), {'b': 1}, WithItems(), None,
+                 [1], 'text', {'a': 'again'}]
+        items += [type('T%d' % i, (object,), {'a': i})() for i in range(10)]
+        self.assertEqual('key,attr,$x.a,A,$x.a,$x.a,$x.a,again,' +
+                         ''.join('%d,' % i for i in range(10)),
+                         template.merge({'items': items}))
+
+    def test_templates_can_be_pickled_after_merging(self):
+        class Local(object):
+            a = 1
+        template = airspeed.Template("$x.a")
+        self.assertEqual('1', template.merge({'x': Local()}))
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(template, protocol))
+            self.assertEqual('2', copy.merge({'x': {'a': 2}}))
+
+    def test_parsed_elements_share_their_source_and_have_no_dicts(self):
+        template = airspeed.Template(
+            '#foreach($i in [1, 2])#if($i > 1)#set($s = "a$i")'
+            '#else$!{y|"z"}#end#end', ''.join(['page', '.vm']))
+        template.ensure_compiled()
+        source = template.root_element.source
+        self.assertEqual(template.content, source.text)
+        sources = set()
+        elements = [template.root_element]
+        while elements:
+            element = elements.pop()
+            self.assertFalse(hasattr(element, '__dict__'), element)
+            self.assertTrue(element.filename is source.filename)
+            sources.add(element.source)
+            elements.extend(element.child_elements())
+        # the text of the template, and of the string "a$i"
+        self.assertEqual(2, len(sources))
+        self.assertTrue(source.filename is six.moves.intern('page.vm'))
+
+    def test_elements_defined_elsewhere_are_pickled_with_their_dicts(self):
+        template = airspeed.Template('#once $x#end')
+        airspeed.UserDefinedDirective.DIRECTIVES.append(LoopOnceDirective)
+        try:
+            template.ensure_compiled()
+        finally:
+            airspeed.UserDefinedDirective.DIRECTIVES.remove(LoopOnceDirective)
+        template = pickle.loads(pickle.dumps(template))
+        self.assertEqual(' 1', template.merge({'x': 1}))
+
+    def test_templates_can_be_pickled_with_every_protocol(self):
+        content = ('#set($n = 1 + 2)#set($l = [$n, "a"])'
+                   '#if($a || $b && !$c)$l[0]#end '
+                   '#foreach($i in $l)${i}$foreach.count #end'
+                   '#set($m = $a * 2 - 1)$!{m}')
+        namespace = {'a': 2, 'b': True, 'c': False}
+        template = airspeed.Template(content)
+        expected = template.merge(dict(namespace))
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(template, protocol))
+            self.assertEqual(expected, copy.merge(dict(namespace)))
+            frame = airspeed.ForeachFrame()
+            frame.count, frame.hasNext = 2, False
+            frame = pickle.loads(pickle.dumps(frame, protocol))
+            self.assertEqual({'count': 2, 'index': 1, 'hasNext': False,
+                              'first': False, 'last': True}, dict(frame))
+
+    def test_adjacent_text_is_joined_and_comments_dropped(self):
+        template = airspeed.Template('a ## c\nb#ffffff #* x *#c')
+        self.assertEqual('a b#ffffff c', template.merge({}))
+        children = template.root_element.block.children
+        self.assertEqual(1, len(children))
+
+    def test_if_branches_with_constant_conditions_are_pruned(self):
+        template = airspeed.Template(
+            'a#if(true)b#else c#end'
+            '#if(false)d#elseif($x)e#elseif(1 < 2)f#else g#end'
+            '#if(false)h#end')
+        self.assertEqual('abe', template.merge({'x': 1}))
+        self.assertEqual('abf', template.merge({}))
+        children = template.root_element.block.children
+        self.assertEqual(2, len(children))
+        if_directive = children[1]
+        self.assertEqual([], if_directive.elseifs)
+        self.assertEqual('f', if_directive.else_block.children[0].text)
+
+    def test_constant_expressions_are_calculated_once(self):
+        template = airspeed.Template(
+            '#set($x = 3 * 4 + 1)#set($s = "plain")#set($t = "$x")$x $s $t')
+        self.assertEqual('13 plain 13', template.merge({}))
+        assignments = [child.assignment
+                       for child in template.root_element.block.children[:3]]
+        self.assertEqual([13, 'plain'],
+                         [assignment.value.value for assignment in assignments[:2]])
+        self.assertFalse(isinstance(assignments[2].value, airspeed._Constant))
+
+    def test_constant_lists_and_dicts_are_not_shared_between_merges(self):
+        template = airspeed.Template(
+            "#set($l = [1, 2])#set($d = {'a': 1})[$!d.b]"
+            "#set($ignore = $l.add(3))#set($ignore = $d.put('b', 2))"
+            "$l $d.b")
+        self.assertEqual('[][1, 2, 3] 2', template.merge({}))
+        self.assertEqual('[][1, 2, 3] 2', template.merge({}))
+
+    def test_failing_constant_expressions_fail_when_merged(self):
+        template = airspeed.Template('#if($a)#set($x = 1 / 0)#end.')
+        self.assertEqual('.', template.merge({}))
+        self.assertRaises(airspeed.TemplateExecutionError,
+                          template.merge, {'a': 1})
+
+    def test_logical_operators_short_circuit(self):
+        calls = []
+
+        def call(value):
+            calls.append(value)
+            return value
+        template = airspeed.Template(
+            "#if($f.call(0) && $f.call(1))a#end"
+            "#if($f.call(2) || $f.call(3))b#end"
+            "#if($f.call(false) or $f.call(4) and $f.call(5))c#end")
+        self.assertEqual('bc', template.merge({'f': {'call': call}}))
+        self.assertEqual([0, 2, False, 4, 5], calls)
+
+    def test_operands_are_calculated_left_to_right(self):
+        calls = []
+
+        def call(value):
+            calls.append(value)
+            return value
+        template = airspeed.Template(
+            "#set($x = $f.call(1) + $f.call(2) * $f.call(3) - $f.call(4))$x")
+        self.assertEqual('3', template.merge({'f': {'call': call}}))
+        self.assertEqual([1, 2, 3, 4], calls)
+
+    def test_constant_parts_of_expressions_are_folded(self):
+        template = airspeed.Template("#set($x = $a + 2 * 3)$x")
+        self.assertEqual('7', template.merge({'a': 1}))
+        tree = template.root_element.block.children[0].assignment.value
+        self.assertEqual(6, tree.calculate.__self__.operand2.value)
+
     def test_template_cannot_modify_its_args(self):
         template = airspeed.Template("#set($foo = 1)")
         ns = {"foo": 2}
@@ -1187,6 +1766,72 @@ line")''')
         output = template.merge({'test_dict': {'k': 'initial value'}})
         self.assertEqual(output, "new value")
 
+    def test_additional_methods_apply_to_subclasses(self):
+        class MyList(list):
+            pass
+        template = airspeed.Template("$foo.size() $foo.contains(2)")
+        self.assertEqual("3 True", template.merge({'foo': MyList([1, 2, 3])}))
+
+    def test_registered_methods(self):
+        class Base(object):
+            def __init__(self, name):
+                self.name = name
+
+        class Derived(Base):
+            pass
+        template = airspeed.Template("$x.greet('hi') $x.name")
+        self.assertEqual("$x.greet('hi') bob",
+                         template.merge({'x': Derived('bob')}))
+        airspeed.register_method(
+            Base, 'greet', lambda self, greeting: greeting + ' ' + self.name)
+        airspeed.register_method(
+            Base, 'name', lambda self: 'hidden by the attribute')
+        try:
+            self.assertEqual("hi bob bob",
+                             template.merge({'x': Derived('bob')}))
+        finally:
+            del airspeed.__additional_methods__[Base]
+            airspeed._additional_method_cache.clear()
+
+    def test_additional_methods_can_be_changed_directly(self):
+        class Thing(object):
+            pass
+        template = airspeed.Template("$x.describe()")
+        self.assertEqual("$x.describe()", template.merge({'x': Thing()}))
+        airspeed.__additional_methods__[Thing] = {
+            'describe': lambda self: 'a thing'}
+        self.addCleanup(airspeed._additional_method_cache.clear)
+        try:
+            self.assertEqual("a thing", template.merge({'x': Thing()}))
+            airspeed.__additional_methods__[Thing]['describe'] = \
+                lambda self: 'still a thing'
+            self.assertEqual("still a thing", template.merge({'x': Thing()}))
+        finally:
+            del airspeed.__additional_methods__[Thing]
+        self.assertEqual("$x.describe()", template.merge({'x': Thing()}))
+
+    def test_replaced_additional_methods_are_noticed(self):
+        class Base(object):
+            pass
+
+        class Thing(Base):
+            pass
+        template = airspeed.Template("$x.describe()")
+        airspeed.__additional_methods__[Base] = {'other': lambda self: 1}
+        self.addCleanup(airspeed._additional_method_cache.clear)
+        try:
+            self.assertEqual("$x.describe()", template.merge({'x': Thing()}))
+            # as many methods as before, so counting them wouldn't tell
+            airspeed.__additional_methods__[Base] = {
+                'describe': lambda self: 'a thing'}
+            self.assertEqual("a thing", template.merge({'x': Thing()}))
+            airspeed.register_method(Base, 'describe',
+                                     lambda self: 'still a thing')
+            self.assertEqual("still a thing", template.merge({'x': Thing()}))
+        finally:
+            del airspeed.__additional_methods__[Base]
+        self.assertEqual("$x.describe()", template.merge({'x': Thing()}))
+
 
     def test_evaluate(self):
         template = airspeed.Template('''#set($source1 = "abc")
@@ -1197,11 +1842,557 @@ line")''')
         output = template.merge({})
         self.assertEqual(output, "abc")
 
+    def test_evaluated_strings_are_parsed_once(self):
+        template = airspeed.Template(
+            "#foreach($i in [1..3])#evaluate('$i-$x;')#end")
+        airspeed.Template.string_cache.clear()
+        self.assertEqual('1-a;2-a;3-a;', template.merge({'x': 'a'}))
+        self.assertEqual(1, len(airspeed.Template.string_cache))
+
+    def test_from_string_cached_reuses_templates(self):
+        template = airspeed.Template.from_string_cached('$a')
+        self.assertTrue(
+            template is airspeed.Template.from_string_cached('$a'))
+        self.assertFalse(
+            template is airspeed.Template.from_string_cached('$a', 'x.vm'))
+        self.assertEqual('b', template.merge({'a': 'b'}))
+
+    def test_profiler_records_elements_across_merges(self):
+        template = airspeed.Template(
+            '#macro(m $x)[$x]#end\n#foreach($i in $l)\n#m($i)#end',
+            'page.vm')
+        template.profiler = airspeed.Profiler()
+        self.assertEqual('\n[1]\n[2]', template.merge({'l': [1, 2]}))
+        self.assertEqual('\n[3]', template.merge({'l': [3]}))
+        entries = dict((entry['text'], entry)
+                       for entry in template.profiler.entries())
+        self.assertEqual(('page.vm', 2, 2, 12),
+                         tuple(entries['#foreach($i in $l)'][name]
+                               for name in ('filename', 'line', 'calls',
+                                            'output')))
+        call = entries['#m($i)']
+        self.assertEqual((3, 3, 9), (call['line'], call['calls'],
+                                     call['output']))
+        self.assertTrue(call['cumulative'] >= call['self'] >= 0)
+        self.assertTrue('page.vm:3 #m($i)' in template.profiler.report())
+        self.assertEqual(
+            entries['#m($i)'],
+            [entry for entry in json.loads(template.profiler.json_report())
+             if entry['text'] == '#m($i)'][0])
+        template.profiler.clear()
+        self.assertEqual([], template.profiler.entries())
+
+    def test_profiler_stats_load_into_pstats(self):
+        template = airspeed.Template('#foreach($i in [1..3])$i#end', 'a.vm')
+        template.profiler = airspeed.Profiler()
+        template.merge({})
+        filename = tempfile.mktemp()
+        try:
+            template.profiler.dump_stats(filename)
+            stats = pstats.Stats(filename)
+        finally:
+            os.remove(filename)
+        self.assertEqual(
+            1, stats.stats[('a.vm', 1, '#foreach($i in [1..3])$i#end')][1])
+
+    def test_profiler_is_off_by_default(self):
+        self.assertEqual(None, airspeed.Template('$a').profiler)
+        self.assertEqual(None, sys.getprofile())
+
+
+class CachingFileLoaderTestCase(TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.basedir, 'cache')
+        self.addCleanup(shutil.rmtree, self.basedir)
+
+    def write(self, name, content):
+        f = open(os.path.join(self.basedir, name), 'w')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+
+    def loader_which_must_not_parse(self):
+        loader = airspeed.CachingFileLoader(self.basedir,
+                                            cache_dir=self.cache_dir)
+
+        def load_text(name):
+            self.fail('%s was parsed again' % name)
+        loader.load_text = load_text
+        return loader
+
+    def test_loads_and_parses_templates(self):
+        self.write('a.vm', 'Hello $name #parse("b.vm")')
+        self.write('b.vm', 'and bye')
+        loader = airspeed.CachingFileLoader(self.basedir)
+        template = loader.load_template('a.vm')
+        self.assertEqual('Hello Bob and bye',
+                         template.merge({'name': 'Bob'}, loader=loader))
+        self.assertTrue(template is loader.load_template('a.vm'))
+
+    def test_known_templates_maps_names_to_templates_and_times(self):
+        self.write('a.vm', 'a')
+        loader = airspeed.CachingFileLoader(self.basedir)
+        template = loader.load_template('a.vm')
+        mtime = os.path.getmtime(os.path.join(self.basedir, 'a.vm'))
+        self.assertEqual({'a.vm': (template, mtime)},
+                         dict(loader.known_templates))
+
+    def test_subclasses_can_load_text_their_own_way(self):
+        class ExclaimingLoader(airspeed.CachingFileLoader):
+            def load_text(self, name):
+                return airspeed.CachingFileLoader.load_text(self, name) + '!'
+        self.write('a.vm', 'a #include("b.txt")')
+        self.write('b.txt', 'b')
+        loader = ExclaimingLoader(self.basedir)
+        self.assertEqual('a b!!', loader.load_template('a.vm').merge(
+            {}, loader=loader))
+
+    def test_parsed_templates_are_reused_from_disk_cache(self):
+        self.write('a.vm', '#foreach($i in [1..3])$i#end')
+        loader = airspeed.CachingFileLoader(self.basedir,
+                                            cache_dir=self.cache_dir)
+        self.assertEqual('123', loader.load_template('a.vm').merge({}))
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+        template = self.loader_which_must_not_parse().load_template('a.vm')
+        self.assertEqual('123', template.merge({}))
+
+    def test_templates_using_every_kind_of_element_reach_disk_cache(self):
+        content = ('#macro(m $x)[$x]#end#set($l = [1, $a])'
+                   '#if($a || $b && !$c)#m(${l[0]|"x"})#elseif($a > 1)e'
+                   '#else#foreach($i in [1..2])$i $!{a}#end#end'
+                   '#set($d = {"k": "v $a"})$d.k ${|\'z\'}')
+        self.write('a.vm', content)
+        namespace = {'a': 2, 'b': True, 'c': False}
+        expected = airspeed.Template(content).merge(dict(namespace))
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            loader = airspeed.CachingFileLoader(self.basedir,
+                                                cache_dir=self.cache_dir)
+            loader.load_template('a.vm')
+        self.assertEqual(1, len(os.listdir(self.cache_dir)))
+        template = self.loader_which_must_not_parse().load_template('a.vm')
+        self.assertEqual(expected, template.merge(dict(namespace)))
+
+    def test_generated_code_is_loaded_from_disk_cache(self):
+        content = '#foreach($i in [1..3])#if($i > 1)$i#else-#end#end'
+        self.write('a.vm', content)
+        airspeed.CachingFileLoader(self.basedir, codegen=True,
+                                   cache_dir=self.cache_dir).load_template(
+                                       'a.vm')
+        compile = airspeed.CodeGenerator.__dict__['compile']
+
+        def compile_again(generator, filename, elements):
+            self.fail('code was generated again')
+        airspeed.CodeGenerator.compile = compile_again
+        try:
+            loader = airspeed.CachingFileLoader(self.basedir, codegen=True,
+                                                cache_dir=self.cache_dir)
+            template = loader.load_template('a.vm')
+        finally:
+            airspeed.CodeGenerator.compile = compile
+        self.assertTrue(callable(template.root_element.block.compiled))
+        self.assertEqual('-23', template.merge({}))
+
+    def test_templates_which_cannot_be_pickled_are_not_stored(self):
+        self.write('a.vm', '$a')
+        filename = os.path.join(self.basedir, 'a.vm')
+        template = airspeed.Template('$a', filename)
+        template.unpicklable = lambda: None
+        cache = airspeed.DiskCache(self.cache_dir)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            cache.store(filename, os.stat(filename), template, False)
+        self.assertEqual([RuntimeWarning], [w.category for w in caught])
+        self.assertEqual(None, cache.load(filename, False))
+
+    def test_disk_cache_entry_is_replaced_when_file_changes(self):
+        self.write('a.vm', 'old')
+        loader = airspeed.CachingFileLoader(self.basedir,
+                                            cache_dir=self.cache_dir)
+        loader.load_template('a.vm')
+        self.write('a.vm', 'new content')
+        loader = airspeed.CachingFileLoader(self.basedir,
+                                            cache_dir=self.cache_dir)
+        self.assertEqual('new content', loader.load_template('a.vm').merge({}))
+        template = self.loader_which_must_not_parse().load_template('a.vm')
+        self.assertEqual('new content', template.merge({}))
+
+    def test_disk_cache_entry_is_kept_when_only_mtime_changes(self):
+        self.write('a.vm', 'same')
+        loader = airspeed.CachingFileLoader(self.basedir,
+                                            cache_dir=self.cache_dir)
+        loader.load_template('a.vm')
+        filename = os.path.join(self.basedir, 'a.vm')
+        os.utime(filename, (0, os.path.getmtime(filename) + 10))
+        template = self.loader_which_must_not_parse().load_template('a.vm')
+        self.assertEqual('same', template.merge({}))
+
+    def test_damaged_disk_cache_entries_are_ignored(self):
+        self.write('a.vm', '$a')
+        loader = airspeed.CachingFileLoader(self.basedir,
+                                            cache_dir=self.cache_dir)
+        loader.load_template('a.vm')
+        for name in os.listdir(self.cache_dir):
+            f = open(os.path.join(self.cache_dir, name), 'wb')
+            f.write(b'garbage')
+            f.close()
+        loader = airspeed.CachingFileLoader(self.basedir,
+                                            cache_dir=self.cache_dir)
+        self.assertEqual('b', loader.load_template('a.vm').merge({'a': 'b'}))
+
+    def test_generated_code_is_rebuilt_for_templates_from_disk_cache(self):
+        self.write('a.vm', '#foreach($i in [1..3])$i#end')
+        loader = airspeed.CachingFileLoader(self.basedir, codegen=True,
+                                            cache_dir=self.cache_dir)
+        loader.load_template('a.vm')
+        loader = airspeed.CachingFileLoader(self.basedir, codegen=True,
+                                            cache_dir=self.cache_dir)
+        template = loader.load_template('a.vm')
+        self.assertTrue(callable(template.root_element.block.compiled))
+        self.assertEqual('123', template.merge({}))
+
+    def test_least_recently_used_templates_are_evicted(self):
+        for name in 'abc':
+            self.write(name, name)
+        loader = airspeed.CachingFileLoader(self.basedir, max_entries=2)
+        a = loader.load_template('a')
+        loader.load_template('b')
+        self.assertTrue(a is loader.load_template('a'))
+        loader.load_template('c')
+        self.assertEqual(['a', 'c'], sorted(loader.known_templates))
+        self.assertEqual({'hits': 1, 'misses': 3, 'evictions': 1,
+                          'entries': 2, 'size': 2, 'text_entries': 0,
+                          'text_size': 0}, loader.stats())
+
+    def test_cache_size_can_be_limited_in_bytes(self):
+        self.write('small', 'x')
+        self.write('large', '$x ' * 1000)
+        size = airspeed.Template('x').approximate_size()
+        loader = airspeed.CachingFileLoader(self.basedir,
+                                            max_bytes=size * 2)
+        loader.load_template('small')
+        self.assertEqual('1 1 ', loader.load_template('large').merge(
+            {'x': 1})[:4])
+        self.assertEqual(['small'], list(loader.known_templates))
+        self.assertEqual(size, loader.stats()['size'])
+
+    def test_template_is_parsed_once_when_requested_concurrently(self):
+        self.write('a.vm', 'a')
+        loader = airspeed.CachingFileLoader(self.basedir)
+        load_text = loader.load_text
+        parsed = []
+
+        def slow_load_text(name):
+            parsed.append(name)
+            time.sleep(0.05)
+            return load_text(name)
+        loader.load_text = slow_load_text
+        templates = []
+        threads = [threading.Thread(
+            target=lambda: templates.append(loader.load_template('a.vm')))
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['a.vm'], parsed)
+        self.assertEqual(8, len(templates))
+        self.assertTrue(all(t is templates[0] for t in templates))
+
+    def test_failed_loads_are_not_cached(self):
+        self.write('a.vm', '#if($a')
+        loader = airspeed.CachingFileLoader(self.basedir)
+        self.assertRaises(airspeed.TemplateSyntaxError,
+                          loader.load_template, 'a.vm')
+        self.assertEqual(0, len(loader.template_cache))
+        self.assertEqual({}, loader.template_cache.loading)
+
+    def touch(self, name, seconds_later):
+        filename = os.path.join(self.basedir, name)
+        mtime = os.path.getmtime(filename) + seconds_later
+        os.utime(filename, (mtime, mtime))
+
+    def test_changed_templates_are_reloaded(self):
+        self.write('a.vm', 'old')
+        loader = airspeed.CachingFileLoader(self.basedir)
+        loader.load_template('a.vm')
+        self.write('a.vm', 'new')
+        self.touch('a.vm', 10)
+        self.assertEqual('new', loader.load_template('a.vm').merge({}))
+
+    def test_files_are_checked_at_most_once_per_check_interval(self):
+        self.write('a.vm', 'old')
+        loader = airspeed.CachingFileLoader(self.basedir, check_interval=60)
+        loader.load_template('a.vm')
+        self.write('a.vm', 'new')
+        self.touch('a.vm', 10)
+        self.assertEqual('old', loader.load_template('a.vm').merge({}))
+        loader.template_cache['a.vm'][2] -= 60
+        self.assertEqual('new', loader.load_template('a.vm').merge({}))
+
+    def test_checks_can_be_turned_off(self):
+        self.write('a.vm', 'old')
+        loader = airspeed.CachingFileLoader(self.basedir, check_interval=None)
+        loader.load_template('a.vm')
+        os.remove(os.path.join(self.basedir, 'a.vm'))
+        self.assertEqual('old', loader.load_template('a.vm').merge({}))
+
+    def test_watcher_drops_changed_templates(self):
+        self.write('a.vm', 'old')
+        self.write('b.vm', 'same')
+        loader = airspeed.CachingFileLoader(self.basedir, watch_interval=0.01)
+        self.addCleanup(loader.close)
+        loader.load_template('a.vm')
+        loader.load_template('b.vm')
+        self.write('a.vm', 'new')
+        self.touch('a.vm', 10)
+        deadline = time.time() + 5
+        while 'a.vm' in loader.known_templates and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(['b.vm'], list(loader.known_templates))
+        self.assertEqual('new', loader.load_template('a.vm').merge({}))
+        loader.close()
+        self.assertFalse(loader.watcher.is_alive())
+
+    def test_macro_libraries_are_available_to_every_template(self):
+        self.write('lib.vm', '#macro(greet $n)Hi $n.#end'
+                             '#macro(twice $n)#greet($n)#greet($n)#end')
+        self.write('a.vm', '#twice($name) #GREET("b")')
+        loader = airspeed.CachingFileLoader(self.basedir,
+                                            macro_libraries=['lib.vm'])
+        namespace = {'name': 'a'}
+        template = loader.load_template('a.vm')
+        for i in range(2):
+            self.assertEqual('Hi a.Hi a. Hi b.',
+                             template.merge(namespace, loader=loader))
+        # nothing is registered in the namespace
+        self.assertEqual({'name': 'a'}, namespace)
+
+    def test_template_macros_take_precedence_over_libraries(self):
+        self.write('lib.vm', '#macro(m)library#end')
+        self.write('parsed.vm', '#macro(p)parsed#end')
+        self.write('a.vm', '#macro(m)own#end#m() #parse("parsed.vm")#p()')
+        loader = airspeed.CachingFileLoader(self.basedir)
+        loader.add_macro_library('lib.vm')
+        self.assertEqual('own parsed', loader.load_template('a.vm').merge(
+            {}, loader=loader))
+        self.assertEqual('library', airspeed.Template('#m()').merge(
+            {}, loader=loader))
+
+    def test_pickled_loader_starts_with_empty_caches(self):
+        self.write('lib.vm', '#macro(m $x)<$x>#end')
+        self.write('a.vm', '#m($a)')
+        loader = airspeed.CachingFileLoader(self.basedir, max_entries=5,
+                                            macro_libraries=['lib.vm'])
+        loader.load_template('a.vm')
+        copy = pickle.loads(pickle.dumps(loader))
+        self.assertEqual(0, copy.stats()['entries'])
+        self.assertEqual(5, copy.template_cache.max_entries)
+        self.assertEqual('<b>', copy.load_template('a.vm').merge(
+            {'a': 'b'}, loader=copy))
+        self.assertEqual(1, copy.stats()['entries'])
+
+    def test_merge_many_shares_the_loader_with_workers(self):
+        self.write('part.vm', '[$i]')
+        template = airspeed.Template('#parse("part.vm")')
+        loader = airspeed.CachingFileLoader(self.basedir)
+        self.assertEqual(['[0]', '[1]', '[2]'], list(template.merge_many(
+            ({'i': i} for i in range(3)), workers=2, loader=loader)))
+
+    def test_included_text_is_cached_until_the_file_changes(self):
+        self.write('a.vm', '#include("b.txt")#include("b.txt")')
+        self.write('b.txt', '$b')
+        loader = airspeed.CachingFileLoader(self.basedir)
+        template = loader.load_template('a.vm')
+        read_text = loader.read_text
+        read = []
+
+        def counting_read_text(name):
+            read.append(name)
+            return read_text(name)
+        loader.read_text = counting_read_text
+        self.assertEqual('$b$b', template.merge({}, loader=loader))
+        self.assertEqual('$b$b', template.merge({}, loader=loader))
+        self.assertEqual(['b.txt'], read)
+        self.write('b.txt', 'c')
+        self.touch('b.txt', 10)
+        self.assertEqual('cc', template.merge({}, loader=loader))
+        self.assertEqual(['b.txt', 'b.txt'], read)
+        self.assertEqual(1, loader.stats()['text_entries'])
+
+    def test_included_text_larger_than_max_bytes_is_not_cached(self):
+        self.write('a.vm', 'a')
+        self.write('b.txt', 'b' * 10000)
+        loader = airspeed.CachingFileLoader(self.basedir, max_bytes=5000)
+        self.assertEqual('b' * 10000, loader.load_text('b.txt'))
+        self.assertEqual(0, len(loader.text_cache))
+        self.assertEqual('a', loader.load_text('a.vm'))
+        self.assertEqual(1, len(loader.text_cache))
+
+
+class AirspeedTestCase(TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.basedir)
+        for name, content in (('lib.vm', '#macro(greet $n)Hi $n.#end'),
+                              ('a.vm', '#greet($name)')):
+            with open(os.path.join(self.basedir, name), 'w') as f:
+                f.write(content)
+
+    def test_macro_libraries_are_found_in_macro_basepath(self):
+        render = Airspeed(macro_libraries=['lib.vm'],
+                          macro_basepath=self.basedir)
+        self.assertEqual(('text/plain', 'Hi Bob.'), render(
+            {'name': 'Bob'}, os.path.join(self.basedir, 'a.vm')))
+
+    def test_macro_libraries_are_found_in_the_current_directory(self):
+        cwd = os.getcwd()
+        os.chdir(self.basedir)
+        try:
+            render = Airspeed(macro_libraries=['lib.vm'])
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(os.path.realpath(self.basedir),
+                         os.path.realpath(render.macro_basepath))
+        self.assertEqual(('text/plain', 'Hi Bob.'), render(
+            {'name': 'Bob'}, os.path.join(self.basedir, 'a.vm')))
+
+
+class MergeManyTestCase(TestCase):
+    template = airspeed.Template('#set($x = $i * 2)$name: $x')
+
+    def namespaces(self, count):
+        return ({'i': i, 'name': 'n%d' % i} for i in range(count))
+
+    def test_outputs_come_in_order(self):
+        self.assertEqual(
+            [self.template.merge(namespace)
+             for namespace in self.namespaces(50)],
+            list(self.template.merge_many(self.namespaces(50), workers=3,
+                                          chunk_size=4)))
+
+    def test_unordered_outputs_come_with_their_index(self):
+        outputs = list(self.template.merge_many(
+            self.namespaces(50), workers=3, ordered=False, chunk_size=4))
+        self.assertEqual(
+            list(enumerate(self.template.merge(namespace)
+                           for namespace in self.namespaces(50))),
+            sorted(outputs))
+
+    def test_namespaces_are_read_only_as_needed(self):
+        read = []
+
+        def namespaces():
+            for namespace in self.namespaces(1000):
+                read.append(namespace)
+                yield namespace
+        for ordered in (True, False):
+            del read[:]
+            outputs = self.template.merge_many(
+                namespaces(), workers=2, ordered=ordered, chunk_size=10,
+                max_pending=3)
+            next(outputs)
+            self.assertTrue(len(read) <= 40, len(read))
+            outputs.close()
+
+    def test_errors_in_workers_are_raised(self):
+        template = airspeed.Template('x\n#if($i == 3)$f(1)#end', 'e.vm')
+        namespaces = [{'i': i, 'f': 5} for i in range(5)]
+        for ordered in (True, False):
+            try:
+                list(template.merge_many(namespaces, workers=2,
+                                         ordered=ordered, chunk_size=1))
+                self.fail('expected exception')
+            except airspeed.TemplateExecutionError as e:
+                self.assertEqual(('e.vm', 14, 19), (e.filename, e.start,
+                                                    e.end))
+                self.assertTrue(isinstance(e.__cause__, TypeError))
+
+    def test_errors_which_cannot_be_sent_back_are_raised(self):
+        template = airspeed.Template('#if($i == 3)$x.fail()#end')
+        namespaces = [{'i': i, 'x': FailsUnpicklably()} for i in range(5)]
+        for ordered in (True, False):
+            self.assertRaises(multiprocessing.pool.MaybeEncodingError, list,
+                              template.merge_many(namespaces, workers=2,
+                                                  ordered=ordered,
+                                                  chunk_size=1))
+
+
+class CodegenTemplateTestCase(TemplateTestCase):
+    """Runs all of the template tests again with code generation enabled."""
+
+    def setUp(self):
+        airspeed.Template.codegen = True
+
+    def tearDown(self):
+        airspeed.Template.codegen = False
+
+    def test_blocks_are_compiled_once(self):
+        template = airspeed.Template('#foreach($i in $items)$i#end')
+        self.assertEqual('123', template.merge({'items': [1, 2, 3]}))
+        block = template.root_element.block
+        compiled = block.compiled
+        self.assertTrue(callable(compiled))
+        self.assertTrue(callable(block.children[0].block.compiled))
+        self.assertEqual('45', template.merge({'items': [4, 5]}))
+        self.assertTrue(compiled is block.compiled)
+
+    def test_generated_code_is_pickled_with_the_template(self):
+        template = airspeed.Template('hello\n#if($a.b(1))x#end', 'tmpl')
+        template.ensure_compiled()
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            copy = pickle.loads(pickle.dumps(template, protocol))
+            self.assertTrue(callable(copy.root_element.block.compiled))
+            self.assertEqual('hello\nx', copy.merge({'a': {'b': bool}}))
+            try:
+                copy.merge({'a': {'b': lambda: None}})
+                self.fail('expected exception')
+            except airspeed.TemplateExecutionError as e:
+                self.assertEqual((6, 23), (e.start, e.end))
+
+    def test_code_pickled_by_other_versions_of_python_is_generated_again(self):
+        template = airspeed.Template('#foreach($i in [1, 2])$i#end')
+        template.ensure_compiled()
+        data = pickle.dumps(template)
+        magic_number = airspeed.CODE_MAGIC_NUMBER
+        airspeed.CODE_MAGIC_NUMBER = b'other'
+        try:
+            copy = pickle.loads(data)
+        finally:
+            airspeed.CODE_MAGIC_NUMBER = magic_number
+        self.assertTrue(callable(copy.root_element.block.compiled))
+        self.assertEqual('12', copy.merge({}))
+
+    def test_if_with_many_elseifs_compiles(self):
+        template = airspeed.Template(
+            '#if($i == 0)0' +
+            ''.join('#elseif($i == %d)%d' % (i, i) for i in range(1, 200)) +
+            '#else none#end')
+        self.assertEqual('150', template.merge({'i': 150}))
+        self.assertEqual(' none', template.merge({'i': 200}))
+
+    def test_codegen_can_be_chosen_per_template(self):
+        template = airspeed.Template('$a', codegen=False)
+        self.assertEqual('b', template.merge({'a': 'b'}))
+        self.assertEqual(None, template.root_element.block.compiled)
+
+    def test_compiled_errors_report_failing_element(self):
+        template = airspeed.Template('hello\n#if($a.b(1))x#end', 'tmpl')
+        try:
+            template.merge({'a': {'b': lambda: None}})
+            self.fail('expected exception')
+        except airspeed.TemplateExecutionError as e:
+            self.assertEqual('tmpl', e.filename)
+            self.assertEqual((6, 23), (e.start, e.end))
+            self.assertTrue(isinstance(e.__cause__, TypeError))
+
+
 # TODO:
 #
 #  Report locations for template errors in files included via loaders
 #  Gobbling up whitespace (see WHITESPACE_TO_END_OF_LINE above, but need to apply in more places)
-# Bind #macro calls at compile time?
 # Scope of #set across if/elseif/else?
 # there seems to be some confusion about the semantics of parameter
 # passing to macros; an assignment in a macro body should persist past the